@@ -0,0 +1,46 @@
+""" Compare the native lxml and the soupparser based parsing of saved
+meeting list pages, e.g. the contents of the page cache:
+
+    python contrib/bench_meetings_parser.py page-cache/objects/*/*
+"""
+import sys
+import codecs
+from timeit import default_timer
+
+from lxml.html import soupparser
+
+from lobbyfacts.data.extract.meetings import fast_parse, parse_html, LISTING
+
+ROWS = LISTING + '/tbody/tr'
+
+
+def bench(name, func, pages, rounds):
+    start = default_timer()
+    for i in range(rounds):
+        rows = [len(func(page).xpath(ROWS)) for page in pages]
+    duration = default_timer() - start
+    print "%-12s %8.3fs %8.2fms/page %6d rows" % (name, duration,
+            1000.0 * duration / (rounds * len(pages)), sum(rows))
+    return rows
+
+
+def main(paths, rounds=3):
+    pages = []
+    for path in paths:
+        with codecs.open(path, 'r', 'utf-8', 'replace') as fh:
+            pages.append(fh.read())
+    pages = [p for p in pages if 'listMeetingsTable' in p]
+    if not len(pages):
+        print "No meeting list pages given."
+        return
+    print "%s pages, %s rounds" % (len(pages), rounds)
+    soup = bench('soupparser', soupparser.fromstring, pages, rounds)
+    fast = bench('lxml.html', fast_parse, pages, rounds)
+    bench('parse_html', parse_html, pages, rounds)
+    if soup != fast:
+        print "Row counts differ on %s pages." % \
+            len([1 for a, b in zip(soup, fast) if a != b])
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -2,20 +2,35 @@
 # -*- coding: utf-8 -*-
 
 import sys, re, requests, time, hashlib, HTMLParser, json
-from lxml.etree import tostring
-from lxml.html.soupparser import fromstring
+from lxml.etree import tostring, ParserError
+from lxml.html import soupparser
+from lxml import html
 from lxml.html import HtmlComment
 from itertools import izip, cycle
-from urlparse import urljoin
+from urlparse import urljoin, urlparse
+from threading import Thread, Lock, BoundedSemaphore
+from Queue import Queue
 from meetingmaps import entmap, uuids
 from datetime import date
+from lobbyfacts.core import app
 from lobbyfacts.data import sl, etl_engine
+from lobbyfacts.data.lib.processing import threaded
+from lobbyfacts.data.lib import pagecache
 import logging
 import sqlalchemy
 log = logging.getLogger(__name__)
 
 HEADERS =  { 'User-agent': 'lobbyfacts/1.2' }
 
+# one pooled session is shared by all crawler threads
+SESSION = requests.Session()
+SESSION.headers.update(HEADERS)
+SESSION.mount('http://', requests.adapters.HTTPAdapter(pool_maxsize=20))
+SESSION.mount('https://', requests.adapters.HTTPAdapter(pool_maxsize=20))
+
+HOST_SLOTS = {}
+HOST_SLOTS_LOCK = Lock()
+
 mainurl="http://ec.europa.eu/transparencyinitiative/meetings/meeting.do?host=595cf53f-c018-4fc8-afa0-9d66c289795c&d-6679426-p="
 trurl="http://ec.europa.eu/transparencyregister/public/consultation/displaylobbyist.do?id="
 tregidre=re.compile('[0-9]{9,12}-[0-9]{2}')
@@ -27,28 +42,67 @@ def unws(obj):
         obj = u''.join(obj)
     return u' '.join(unicode(obj).split())
 
-def fetch_raw(url, retries=5, ignore=[], params=None):
+def host_slot(url):
+    """ Semaphore limiting the number of concurrent requests per host. """
+    host = urlparse(url).netloc
+    with HOST_SLOTS_LOCK:
+        if host not in HOST_SLOTS:
+            limit = app.config.get('ETL_CRAWL_HOST_LIMIT', 4)
+            HOST_SLOTS[host] = BoundedSemaphore(limit)
+        return HOST_SLOTS[host]
+
+def fetch_response(url, retries=5, ignore=[], params=None):
     try:
-        if params:
-            r=requests.POST(url, params=params, headers=HEADERS)
-        else:
-            r=requests.get(url, headers=HEADERS)
+        with host_slot(url):
+            if params:
+                r=SESSION.post(url, params=params)
+            else:
+                r=SESSION.get(url)
     except (requests.exceptions.ConnectionError, requests.exceptions.Timeout), e:
-        if e == requests.exceptions.Timeout:
+        if isinstance(e, requests.exceptions.Timeout):
             retries = min(retries, 1)
         if retries>0:
             time.sleep(4*(6-retries))
-            f=fetch_raw(url, retries-1, ignore=ignore, params=params)
+            return fetch_response(url, retries-1, ignore=ignore, params=params)
         else:
             raise ValueError("failed to fetch %s" % url)
     if r.status_code >= 400 and r.status_code not in [504, 502]+ignore:
         print >>sys.stderr, "[!] %d %s" % (r.status_code, url)
         r.raise_for_status()
-    return r.text
+    return r
+
+def fetch_raw(url, retries=5, ignore=[], params=None):
+    page = pagecache.get(url, lambda: fetch_response(url, retries, ignore, params),
+                         params=params)
+    return page.text
+
+LISTING = '//table[@id="listMeetingsTable"]'
+PREDECESSORS = '//div[@id="titlerefpage"]'
+
+def fast_parse(text):
+    try:
+        return html.fromstring(text)
+    except ValueError:
+        # unicode input with an encoding declaration
+        parser = html.HTMLParser(encoding='utf-8')
+        return html.fromstring(text.encode('utf-8'), parser=parser)
+
+def parse_html(text, marker=LISTING):
+    """ Parse a page with the native lxml HTML parser, falling back
+    to the BeautifulSoup based parser (an order of magnitude slower)
+    only when the fast parse does not contain `marker`. """
+    try:
+        root = fast_parse(text)
+        if marker is None or len(root.xpath(marker)):
+            return root
+    except ParserError:
+        pass
+    log.debug("Falling back to soupparser")
+    return soupparser.fromstring(text)
 
-def fetch(url, retries=5, ignore=[], params=None):
+def fetch(url, retries=5, ignore=[], params=None, marker=LISTING):
     f = fetch_raw(url, retries, ignore, params)
-    return fromstring(f)
+    return parse_html(f, marker)
 
 host2portfolio = { u"President Jean-Claude Juncker" : "Presidency",
                    u"Commissioner Günther Oettinger":"Digital Economy",
@@ -108,7 +162,8 @@ def get_urls():
         predurl = root.xpath('//a[text()="List of predecessors"]')
         if len(predurl)==1:
             # get predecessors urls
-            predroot = fetch(urljoin(url, predurl[0].get('href')))
+            predroot = fetch(urljoin(url, predurl[0].get('href')),
+                             marker=PREDECESSORS)
             for pred in predroot.xpath('//div[@id="titlerefpage"]/following-sibling::a'):
                 if pred.xpath('./text()')[0].startswith('Back to '):
                     break
@@ -152,13 +207,17 @@ def get_ents(nodes):
         ents.append((name, tregid))
     return ents
 
-def scrape(url, title, org):
+def scrape(url, title, org, known=None):
+    """ Follow the meeting list of a host from the newest page on. If a
+    set of `known` meeting ids is given, stop after the first page that
+    holds only known meetings. """
     while True:
         try: root = fetch(url)
         except:
             print >>sys.stderr, 'failed to fetch url', sys.exc_info(), url
             break
 
+        page = set()
         for row in root.xpath('//table[@id="listMeetingsTable"]/tbody/tr'):
             fields = row.xpath('.//td')
             if len(fields) == 5:
@@ -181,6 +240,8 @@ def scrape(url, title, org):
             for lm in (name, date, location, '\0'.join('\1'.join(e) for e in entities), subject, org):
                 meetid = hashlib.md5(meetid.digest()+lm.encode('utf8'))
             meetid = meetid.hexdigest()
+            if len(entities):
+                page.add(meetid)
             for entity, entity_id in entities:
                 yield {'name': name,
                        'status': 'active',
@@ -192,24 +253,71 @@ def scrape(url, title, org):
                        'representative': entity,
                        'eu_representative': org}
 
+        if known is not None and len(page) and page.issubset(known):
+            log.debug("Reached known meetings of %s", org)
+            break
         try: url=urljoin(mainurl, root.xpath('//a/img[@alt="Next"]/..')[0].attrib['href'])
         except: break
 
-def extract(engine):
+def crawl(chains, known=None, num_threads=None):
+    """ Scrape the meeting lists of several hosts in parallel, each
+    host's pagination chain in order, and hand all meetings back to
+    the calling thread. `known` maps each eu_representative to the
+    meeting ids that are already stored, for an incremental crawl. """
+    if num_threads is None:
+        num_threads = app.config.get('ETL_CRAWL_THREADS', 8)
+    results = Queue(maxsize=1000)
+
+    def crawl_chain(chain):
+        url, org, title = chain
+        known_ = None if known is None else known.get(org, set())
+        for meeting in scrape(url, title, org, known_):
+            results.put(meeting)
+
+    def run():
+        try:
+            threaded(chains, crawl_chain, num_threads=num_threads)
+        finally:
+            results.put(None)
+
+    t = Thread(target=run)
+    t.daemon = True
+    t.start()
+    while True:
+        meeting = results.get()
+        if meeting is None:
+            break
+        yield meeting
+
+def load_known(engine):
+    known = {}
     table = sl.get_table(engine, 'meeting')
-    try:
-        sl.update(engine, 'meeting', {}, {'status': 'inactive'}, ensure=False)
-        sl.update(engine, 'meeting_participants', {}, {'status': 'inactive'}, ensure=False)
-    except sqlalchemy.exc.CompileError:
-        pass
+    if 'meetid' not in table.c:
+        return known
+    for row in sl.distinct(engine, table, 'eu_representative', 'meetid'):
+        known.setdefault(row['eu_representative'], set()).add(row['meetid'])
+    return known
+
+def extract(engine, full=False):
+    """ Crawl the meeting lists. By default only the new meetings at
+    the head of each list are fetched; `full` recrawls all of them and
+    marks meetings that have disappeared as inactive. """
+    table = sl.get_table(engine, 'meeting')
+    known = None
+    if full:
+        try:
+            sl.update(engine, 'meeting', {}, {'status': 'inactive'}, ensure=False)
+            sl.update(engine, 'meeting_participants', {}, {'status': 'inactive'}, ensure=False)
+        except sqlalchemy.exc.CompileError:
+            pass
+    else:
+        known = load_known(engine)
 
-    i=0
-    for url, org, title in get_urls():
-        for meeting in scrape(url, title, org):
-            sl.upsert(engine, table, meeting, ['meetid', 'identification_code'])
-            i+=1
-            if i % 100 == 0:
-                log.info("Extracted: %s...", i)
+    chains = list(get_urls())
+    for i, meeting in enumerate(crawl(chains, known)):
+        sl.upsert(engine, table, meeting, ['meetid', 'identification_code'])
+        if i % 100 == 0:
+            log.info("Extracted: %s...", i)
 
 
 if __name__ == '__main__':
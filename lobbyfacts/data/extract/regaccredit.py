@@ -3,9 +3,10 @@ import logging, sys
 from lxml import etree
 from pprint import pprint
 
-import requests
-
 from lobbyfacts.data import sl, etl_engine
+from lobbyfacts.data.lib.bulk import BulkWriter
+from lobbyfacts.data.lib.generation import new_run, finalize, RUN_COLUMN
+from lobbyfacts.data.lib import download
 
 log = logging.getLogger(__name__)
 
@@ -32,35 +33,69 @@ def parse(data):
             }
         yield ap
 
-def save(person, engine):
-    table = sl.get_table(engine, 'person')
-    orgs = list(sl.find(engine, sl.get_table(engine, 'representative'),
-                   identification_code=person['org_identification_code']))
-    if len(orgs):
-        org = max(orgs, key=lambda o: o['last_update_date'])
-        person['representative_etl_id'] = org['etl_id']
-        person['role'] = 'accredited'
-        person['status'] = 'active'
-        name = '%s %s %s' % (person['title'] or '',
-                             person['first_name'] or '',
-                             person['last_name'] or '')
-        person['name'] = name.strip()
-        log.debug("Accreditation: %s", name)
-        sl.upsert(engine, table, person,
-            ['representative_etl_id', 'role', 'name'])
-    else:
-        log.warn("Cannot associate with a registered interest: %r", person)
+def load_representatives(engine):
+    """ Map each identification code to the etl_id of its most recently
+    updated representative. """
+    latest = {}
+    table = sl.get_table(engine, 'representative')
+    for rep in sl.distinct(engine, table, 'identification_code', 'etl_id',
+                           'last_update_date'):
+        code = rep['identification_code']
+        if code not in latest or rep['last_update_date'] > latest[code][0]:
+            latest[code] = (rep['last_update_date'], rep['etl_id'])
+    return dict((k, v[1]) for k, v in latest.items())
+
+def save(person, writer, representatives, run=None):
+    etl_id = representatives.get(person['org_identification_code'])
+    if etl_id is None:
+        return False
+    person['representative_etl_id'] = etl_id
+    person['role'] = 'accredited'
+    person['status'] = 'active'
+    person[RUN_COLUMN] = run
+    name = '%s %s %s' % (person['title'] or '',
+                         person['first_name'] or '',
+                         person['last_name'] or '')
+    person['name'] = name.strip()
+    log.debug("Accreditation: %s", name)
+    writer.upsert('person', person,
+        ['representative_etl_id', 'role', 'name'])
+    return True
+
+def accredited(table):
+    return table.c.role == 'accredited'
 
 def extract_data(engine, data):
+    """ Write the accredited persons and deactivate the ones that are no
+    longer listed. """
     log.info("Extracting accredditation data...")
-    for i, ap in enumerate(parse(data)):
-        save(ap, engine)
-        if i % 100 == 0:
-            log.info("Extracted: %s...", i)
+    run = new_run()
+    representatives = load_representatives(engine)
+    unmatched = set()
+    with BulkWriter(engine) as writer:
+        for i, ap in enumerate(parse(data)):
+            if not save(ap, writer, representatives, run):
+                unmatched.add(ap['org_identification_code'])
+            if i % 100 == 0:
+                log.info("Extracted: %s...", i)
+    if len(unmatched):
+        log.warn("Cannot associate accreditations with %s registered "
+                 "interests: %s", len(unmatched),
+                 ', '.join(sorted(c or '' for c in unmatched)))
+    finalize(engine, ['person'], run, {'person': accredited})
 
-def extract(engine):
-    res = requests.get(URL)
-    extract_data(engine, res.content.decode('utf-8'))
+def extract(engine, full=False, registry_changed=True):
+    """ Extract unless both the source file and the register of
+    interests it refers to are unchanged. """
+    changed, fh = download.fetch(URL, force=full)
+    try:
+        if not changed and not registry_changed:
+            log.info("Accreditations are unchanged, skipping.")
+            return
+        extract_data(engine, fh.read().decode('utf-8'))
+        download.mark_done(URL)
+    finally:
+        fh.close()
 
 if __name__ == '__main__':
     engine = etl_engine()
@@ -3,15 +3,22 @@ from datetime import datetime
 from pprint import pprint
 from urlparse import urljoin
 from itertools import count
+from threading import Lock
 from lxml import html
 import requests
 
+from lobbyfacts.core import app
 from lobbyfacts.data import sl, etl_engine
+from lobbyfacts.data.lib import pagecache
+from lobbyfacts.data.lib.processing import threaded, RateLimiter
 
 log = logging.getLogger(__name__)
 
 URL = 'http://ec.europa.eu/transparency/regexpert/index.cfm?do=search.result&page=%s'
 
+# shared by all scraper threads
+LIMITER = RateLimiter(app.config.get('ETL_REGEXPERT_RATE', 4))
+
 FIELDS = {
         'Task': 'task',
         'Mission': 'mission'
@@ -31,16 +38,24 @@ def pseudotable(el):
             data[label] = flds
     return data
 
+def fetch(url, data=None):
+    def request():
+        LIMITER.wait()
+        if data is not None:
+            return requests.post(url, data=data)
+        return requests.get(url)
+    return pagecache.get(url, request, params=data)
+
 def scrape_member(url):
     data = {'url': url}
-    res = requests.get(url)
+    res = fetch(url)
     doc = html.document_fromstring(res.content)
     data.update(pseudotable(doc.find('.//fieldset')))
     return data
 
 def scrape_group(url):
     data = {'url': url}
-    res = requests.get(url)
+    res = fetch(url)
     doc = html.document_fromstring(res.content)
 
     gdetails = doc.find('.//*[@id="groupDetails"]')
@@ -104,22 +119,23 @@ def scrape_group(url):
     return data
 
 def scrape_index():
+    query = {
+        'searchType': 'simple',
+        'searchByCheck': 0,
+        'SearchBy': 0,
+        'selectiontype_Group': 2,
+        'dg_type': 1,
+        'selectiontype_DG': 1,
+        'Submit': 'Search'
+        }
     for i in count(1):
-        res = requests.post(URL % i, data={
-            'searchType': 'simple',
-            'searchByCheck': 0,
-            'SearchBy': 0,
-            'selectiontype_Group': 2,
-            'dg_type': 1,
-            'selectiontype_DG': 1,
-            'Submit': 'Search'
-            })
+        res = fetch(URL % i, data=query)
         doc = html.document_fromstring(res.content)
         links = doc.findall('.//table[@class="listContentContainer"]//a')
         if not len(links):
             return
         for link in links:
-            yield scrape_group(urljoin(URL, link.get('href')))
+            yield urljoin(URL, link.get('href'))
 
 def save_member(engine, etlId, member):
     member = dict(member.items())
@@ -201,9 +217,47 @@ def save(engine, group):
     #pprint(group)
 
 
-def extract(engine):
-    for group in scrape_index():
-        save(engine, group)
+def load_checkpoints(engine):
+    table = sl.get_table(engine, 'expertgroup_checkpoint')
+    if 'url' not in table.c:
+        return set()
+    return set(r['url'] for r in sl.distinct(engine, table, 'url'))
+
+def extract(engine, full=False):
+    """ Scrape all expert groups on a pool of threads. Each finished
+    group is checkpointed in the ETL database, so that an interrupted
+    run resumes with the groups that are still missing; checkpoints
+    are cleared once every group has been saved. """
+    table = sl.get_table(engine, 'expertgroup_checkpoint')
+    if full:
+        sl.delete(engine, table)
+    done = load_checkpoints(engine)
+    urls = [u for u in scrape_index() if u not in done]
+    log.info("Expert groups to scrape: %s (%s done before)", len(urls),
+             len(done))
+    lock = Lock()
+    failed = []
+
+    def process(url):
+        try:
+            group = scrape_group(url)
+            with lock:
+                save(engine, group)
+                sl.upsert(engine, table, {'url': url,
+                                          'identifier': group['identifier'],
+                                          'completed_at': datetime.utcnow()},
+                          ['url'])
+        except Exception, e:
+            log.exception(e)
+            failed.append(url)
+
+    threaded(urls, process,
+             num_threads=app.config.get('ETL_REGEXPERT_THREADS', 8))
+    if len(failed):
+        log.warn("Failed to extract %s expert groups, run again to resume.",
+                 len(failed))
+    else:
+        sl.delete(engine, table)
 
 if __name__ == '__main__':
     engine = etl_engine()
@@ -1,11 +1,18 @@
 from datetime import datetime
+from hashlib import sha1
 from lxml import etree
+import sqlalchemy
+from sqlalchemy import or_
 from pprint import pprint
+from multiprocessing import Pool
 import logging
 
-import requests, sys
+import sys
+from lobbyfacts.core import app
 from lobbyfacts.data import sl, etl_engine
-import sqlalchemy
+from lobbyfacts.data.lib.bulk import BulkWriter, bulk_update, ensure_columns
+from lobbyfacts.data.lib.generation import new_run, finalize, RUN_COLUMN
+from lobbyfacts.data.lib import download
 
 log = logging.getLogger(__name__)
 
@@ -14,13 +21,250 @@ NS2 = "{http://www.w3.org/1999/xlink}"
 NS = "{http://intragate.ec.europa.eu/transparencyregister/intws/20141104}"
 SI = "{http://www.w3.org/2001/XMLSchema-instance}"
 
+# staging tables written by load_rep, keyed by representative_etl_id
+CHILD_TABLES = ['contact', 'person', 'action_field', 'interest',
+                'country_of_member', 'organisation', 'financial_data',
+                'financial_data_custom_source', 'financial_data_turnover']
+
+# tables whose rows become inactive when a run does not touch them
+STATUS_TABLES = ['representative', 'contact', 'financial_data',
+                 'financial_data_turnover', 'person', 'organisation',
+                 'accreditation', 'country_of_member', 'associated_action']
+
 def dateconv(ds):
     return datetime.strptime(ds.split("+")[0].strip(), "%Y-%m-%dT%H:%M:%S.%f")
 
 def intconv(val):
     return val
 
+XNS = {'tr': NS[1:-1], 'xl': NS2[1:-1], 'xsi': SI[1:-1]}
+
+def _xpath(expr):
+    return etree.XPath(expr, namespaces=XNS)
+
+def _text(expr):
+    """ Compile `expr` once into a function with the semantics of
+    ``findtext``: the text of the first match, '' for an empty
+    element and None if nothing matches. """
+    xpath = _xpath('(%s)[1]' % expr)
+    def text(el):
+        found = xpath(el)
+        if not len(found):
+            return None
+        return found[0].text or ''
+    return text
+
+def _texts(expr):
+    xpath = _xpath(expr)
+    return lambda el: [e.text for e in xpath(el)]
+
+def _plan(fields):
+    return [(key, _text(expr), conv) for key, expr, conv in fields]
+
+def _apply(plan, el, data):
+    for key, text, conv in plan:
+        value = text(el)
+        data[key] = conv(value) if conv else value
+    return data
+
+REP_PLAN = _plan([
+    ('identification_code', 'tr:identificationCode', None),
+    ('status', 'tr:status', None),
+    ('registration_date', 'tr:registrationDate', dateconv),
+    ('last_update_date', 'tr:lastUpdateDate', dateconv),
+    ('legal_status', 'tr:legalStatus', None),
+    ('acronym', 'tr:acronym', None),
+    ('main_category', './/tr:mainCategory', None),
+    ('sub_category', './/tr:subCategory', None),
+    ('goals', 'tr:goals', None),
+    ('activity_consult_committees', './/tr:activities/tr:activityConsultCommittees', None),
+    ('activity_eu_legislative', './/tr:activities/tr:activityEuLegislative', None),
+    ('activity_expert_groups', './/tr:activities/tr:activityExpertGroups', None),
+    ('activity_high_level_groups', './/tr:activities/tr:activityHighLevelGroups', None),
+    ('activity_industry_forums', './/tr:activities/tr:activityIndustryForums', None),
+    ('activity_inter_groups', './/tr:activities/tr:activityInterGroups', None),
+    ('activity_other', './/tr:activities/tr:activityOther', None),
+    ('activity_relevant_comm', './/tr:activities/tr:activityRelevantComm', None),
+    ('code_of_conduct', './/tr:codeOfConduct', None),
+    ('members_25', './/tr:members25Percent', None),
+    ('members_50', './/tr:members50Percent', None),
+    ('members_75', './/tr:members75Percent', None),
+    ('members_100', './/tr:members100Percent', None),
+    ('members_fte', './/tr:membersFTE', None),
+    ('info_members', './/tr:infoMembers', None),
+    ('members', './/tr:members/tr:members', None),
+    ('number_of_natural_persons', './/tr:structure/tr:numberOfNaturalPersons', intconv),
+    ('structure_members', './/tr:structure/tr:structureMembers', None),
+    ('networking', './/tr:structure/tr:networking', None),
+    ])
+
+PERSON_FIELDS = [('title', 'title', None),
+                 ('first_name', 'firstName', None),
+                 ('last_name', 'lastName', None),
+                 ('position', 'position', None)]
+LEGAL_PLAN = _plan([(k, 'tr:legalResp/tr:' + e, c) for k, e, c in PERSON_FIELDS])
+HEAD_PLAN = _plan([(k, 'tr:euRelationsResp/tr:' + e, c) for k, e, c in PERSON_FIELDS])
+
+def _contact_plan(tag):
+    return _plan([
+        ('addressline1', tag + '/tr:addressline1', None),
+        ('addressline2', tag + '/tr:addressline2', None),
+        ('postbox', tag + '/tr:postBox', None),
+        ('post_code', tag + '/tr:postCode', None),
+        ('town', tag + '/tr:town', None),
+        ('country', tag + '/tr:country', None),
+        ('indic_phone', tag + '//tr:phone/tr:indicPhone', None),
+        ('phone', tag + '//tr:phone/tr:phoneNumber', None),
+        ])
+CONTACT_PLANS = [('head_contact', 'head', _contact_plan('tr:contactDetails')),
+                 ('be_contact', 'belgium', _contact_plan('tr:contactDetailsBelgium'))]
+
+LATIN_NAME = _text('.//tr:nameInLatinAlphabet')
+ORIGINAL_NAME = _text('.//tr:originalName')
+WEB_SITE_URL = _xpath('tr:webSiteURL[1]/@xl:href')
+OHER_CODE_OF_CONDUCT = _text('.//tr:oherCodeOfConduct')
+OTHER_CODE_OF_CONDUCT = _text('.//tr:otherCodeOfConduct')
+ACTION_FIELDS = _texts('.//tr:actionField/tr:actionField')
+INTERESTS = _texts('.//tr:interest/tr:name')
+COUNTRY_OF_MEMBERS = _texts('(tr:structure/tr:countries)[1]//tr:country')
+ORGANISATIONS = _xpath('(tr:structure/tr:organisations)[1]/tr:organisation')
+ORGANISATION_PLAN = _plan([('name', 'tr:name', None),
+                           ('number_of_members', 'tr:numberOfMembers', None)])
+
+FINANCIAL_DATA = _xpath('tr:financialData[1]')
+NEW_ORGANISATION = _text('tr:newOrganisation')
+START_DATE = _text('tr:startDate')
+FD_PLAN = _plan([
+    ('end_date', 'tr:endDate', dateconv),
+    ('eur_sources_procurement', 'tr:eurSourcesProcurement', intconv),
+    ('eur_sources_procurement_src', 'tr:eurSourcesProcurementSrc', None),
+    ('eur_sources_grants', 'tr:eurSourcesGrants', intconv),
+    ('eur_sources_grants_src', 'tr:eurSourcesGrantsSrc', None),
+    ])
+OTHER_FINANCIAL_INFORMATION = _text('tr:otherFinancialInformation')
+FINANCIAL_INFORMATION = _xpath('tr:financialInformation[1]')
+FI_TYPE = _xpath('@xsi:type')
+FI_PLAN = _plan([
+    ('no_clients', 'tr:noClientsInfo', None),
+    ('total_budget', './/tr:totalBudget', intconv),
+    ('public_financing_total', './/tr:totalPublicFinancing', intconv),
+    ('public_financing_national', './/tr:nationalSources', intconv),
+    ('public_financing_infranational', './/tr:infranationalSources', intconv),
+    ('other_sources_total', './/tr:totalOtherSources', intconv),
+    ('other_sources_donation', './/tr:donation', intconv),
+    ('other_sources_contributions', './/tr:contributions', intconv),
+    ('direct_rep_costs_min', './/tr:directRepresentationCosts//tr:min', intconv),
+    ('direct_rep_costs_max', './/tr:directRepresentationCosts//tr:max', intconv),
+    ('cost_min', './/tr:cost//tr:min', intconv),
+    ('cost_max', './/tr:cost//tr:max', intconv),
+    ('cost_absolute', './/tr:cost//tr:absoluteCost', intconv),
+    ('turnover_min', './/tr:turnover//tr:min', intconv),
+    ('turnover_max', './/tr:turnover//tr:max', intconv),
+    ('turnover_absolute', './/tr:turnover//tr:absoluteAmount', intconv),
+    ])
+CUSTOMISED_SOURCES = [
+    ('public_customized', _xpath('(.//tr:customisedPublicSources)[1]//tr:customisedSource')),
+    ('other_customized', _xpath('(.//tr:customisedOther)[1]//tr:customisedSource'))]
+SOURCE_PLAN = _plan([('name', 'tr:name', None),
+                     ('amount', 'tr:amount', intconv)])
+BREAKDOWNS = [(False, _xpath('tr:turnoverBreakdown[1]')),
+              (True, _xpath('tr:newTurnoverBreakdown[1]'))]
+ABSOLUTE_RANGES = _xpath('tr:customersGroupsInAbsoluteRange')
+PERCENTAGE_RANGES = _xpath('tr:customersGroupsInPercentageRange')
+RANGE_MIN = _text('.//tr:min')
+RANGE_MAX = _text('.//tr:max')
+CUSTOMERS = _xpath('.//tr:customer')
+CUSTOMER_NAME = _text('tr:name')
+
 def parse_rep(rep_el):
+    """ Parse an interestRepresentative element using the XPath plans
+    compiled above. The output is identical to that of
+    parse_rep_reference. """
+    rep = _apply(REP_PLAN, rep_el, {})
+    latin_name = LATIN_NAME(rep_el)
+    if latin_name:
+        rep['original_name'] = latin_name
+        rep['native_name'] = ORIGINAL_NAME(rep_el)
+    else:
+        rep['original_name'] = ORIGINAL_NAME(rep_el)
+    href = WEB_SITE_URL(rep_el)
+    rep['web_site_url'] = href[0] if len(href) else None
+    rep['legal_person'] = _apply(LEGAL_PLAN, rep_el, {})
+    rep['head_person'] = _apply(HEAD_PLAN, rep_el, {})
+
+    for key, type_, plan in CONTACT_PLANS:
+        contact = _apply(plan, rep_el, {})
+        line1 = contact.pop('addressline1') or ''
+        line2 = contact.pop('addressline2') or ''
+        # addressline2 is repeated, as in the reference parser.
+        contact['street'] = ' '.join((line1, line2, line2))
+        contact['type'] = type_
+        rep[key] = contact
+
+    rep['other_code_of_conduct'] = OHER_CODE_OF_CONDUCT(rep_el) or \
+            OTHER_CODE_OF_CONDUCT(rep_el)
+    rep['action_fields'] = ACTION_FIELDS(rep_el)
+    rep['interests'] = INTERESTS(rep_el)
+    rep['country_of_members'] = COUNTRY_OF_MEMBERS(rep_el)
+    rep['organisations'] = [_apply(ORGANISATION_PLAN, org_el, {})
+                            for org_el in ORGANISATIONS(rep_el)]
+
+    fd_el = FINANCIAL_DATA(rep_el)[0]
+    fd = {}
+    rep['new_organisation'] = NEW_ORGANISATION(fd_el)
+    try:
+        fd['start_date'] = dateconv(START_DATE(fd_el))
+    except AttributeError:
+        if rep['new_organisation'] != 'true':
+            print >>sys.stderr, '[x] missing financial data, check out:', rep['identification_code']
+        rep['fd'] = fd
+        return rep
+    _apply(FD_PLAN, fd_el, fd)
+    fi = FINANCIAL_INFORMATION(fd_el)[0]
+    type_ = FI_TYPE(fi)
+    fd['type'] = type_[0] if len(type_) else None
+    _apply(FI_PLAN, fi, fd)
+    for key, sources in CUSTOMISED_SOURCES:
+        fd[key] = [_apply(SOURCE_PLAN, src_el, {}) for src_el in sources(fi)]
+
+    fd['turnover_breakdown'] = []
+    for newbd, breakdown in BREAKDOWNS:
+        for tb in breakdown(fi):
+            for range_ in ABSOLUTE_RANGES(tb):
+                max_ = RANGE_MAX(range_)
+                min_ = RANGE_MIN(range_)
+                for customer in CUSTOMERS(range_):
+                    fd['turnover_breakdown'].append({
+                        'name': CUSTOMER_NAME(customer),
+                        'new': newbd,
+                        'min': intconv(min_),
+                        'max': intconv(max_)
+                        })
+            for range_ in PERCENTAGE_RANGES(tb):
+                max_ = RANGE_MAX(range_)
+                if max_:
+                    max_ = float(max_) / 100.0 * \
+                            float(fd['turnover_absolute'] or
+                                  fd['turnover_max'] or fd['turnover_min'])
+                min_ = RANGE_MIN(range_)
+                if min_:
+                    min_ = float(min_) / 100.0 * \
+                            float(fd['turnover_absolute'] or
+                                  fd['turnover_min'] or fd['turnover_max'])
+                for customer in CUSTOMERS(range_):
+                    fd['turnover_breakdown'].append({
+                        'name': CUSTOMER_NAME(customer),
+                        'new': newbd,
+                        'min': intconv(min_),
+                        'max': intconv(max_)
+                        })
+    fd['other_financial_information'] = OTHER_FINANCIAL_INFORMATION(fd_el)
+    rep['fd'] = fd
+    return rep
+
+def parse_rep_reference(rep_el):
+    """ The original ElementPath parser, kept as a reference to check
+    the compiled plan against. """
     rep = {}
     rep['identification_code'] = rep_el.findtext(NS + 'identificationCode')
     rep['status'] = rep_el.findtext(NS + 'status')
@@ -240,27 +484,25 @@ def parse_rep(rep_el):
     rep['fd'] = fd
     return rep
 
-def load_person(person, role, childBase, engine):
-    table = sl.get_table(engine, 'person')
+def load_person(person, role, childBase, writer):
     person_ = childBase.copy()
     person_.update(person)
     person_['role'] = role
     person_['name'] = ' '.join((person['title'] or '',
                                 person['first_name'] or '',
                                 person['last_name'] or ''))
-    sl.upsert(engine, table, person_, ['representative_etl_id',
-                                       'role',
-                                       'name'])
+    writer.upsert('person', person_, ['representative_etl_id',
+                                      'role',
+                                      'name'])
 
 
-def load_contact(contact, childBase, engine):
+def load_contact(contact, childBase, writer):
     if contact == {}: return
-    table = sl.get_table(engine, 'contact')
     contact_ = childBase.copy()
     contact_.update(contact)
-    sl.upsert(engine, table, contact_, ['representative_etl_id', 'country', 'type'])
+    writer.upsert('contact', contact_, ['representative_etl_id', 'country', 'type'])
 
-def load_finances(financialData, childBase, engine):
+def load_finances(financialData, childBase, writer):
     if financialData == {}: return
     etlId = '%s//%s' % (financialData['start_date'].isoformat(),
                         financialData['end_date'].isoformat())
@@ -272,100 +514,218 @@ def load_finances(financialData, childBase, engine):
         financial_source['type'] = type_
         financial_source['financial_data_etl_id'] = etlId
         financial_source.update(childBase)
-        sl.upsert(engine, sl.get_table(engine, 'financial_data_custom_source'),
-                  financial_source, ['representative_etl_id',
-                      'financial_data_etl_id', 'type', 'name'])
+        writer.upsert('financial_data_custom_source',
+                      financial_source, ['representative_etl_id',
+                          'financial_data_etl_id', 'type', 'name'])
 
     for turnover in financialData.pop("turnover_breakdown"):
         turnover['financial_data_etl_id'] = etlId
         turnover['name'] = turnover['name'].strip()
         turnover.update(childBase)
-        sl.upsert(engine, sl.get_table(engine, 'financial_data_turnover'),
-                  turnover, ['representative_etl_id', 'financial_data_etl_id',
-                             'name'])
+        writer.upsert('financial_data_turnover',
+                      turnover, ['representative_etl_id', 'financial_data_etl_id',
+                                 'name'])
 
     financialData['etl_id'] = etlId
     financialData.update(childBase)
-    sl.upsert(engine, sl.get_table(engine, 'financial_data'),
-              financialData, ['representative_etl_id', 'etl_id'])
+    writer.upsert('financial_data',
+                  financialData, ['representative_etl_id', 'etl_id'])
     #pprint(financialData)
 
 
-def load_rep(rep, engine):
-    #etlId = rep['etlId'] = "%s//%s" % (rep['identificationCode'],
-    #                                   rep['lastUpdateDate'].isoformat())
-    etlId = rep['etl_id'] = "%s//ALL" % rep['identification_code']
+def make_etl_id(identification_code):
+    #return "%s//%s" % (rep['identificationCode'],
+    #                   rep['lastUpdateDate'].isoformat())
+    return "%s//ALL" % identification_code
+
+def load_rep(rep, writer, run=None):
+    etlId = rep['etl_id'] = make_etl_id(rep['identification_code'])
     childBase = {'representative_etl_id': etlId,
                  'representative_update_date': rep['last_update_date'],
-                 'status': 'active'}
+                 'status': 'active',
+                 RUN_COLUMN: run}
     if not rep['original_name']:
         log.error("Unnamed representative: %r", rep)
         return
 
-    load_contact(rep.pop('head_contact',{}), childBase, engine)
-    load_contact(rep.pop('be_contact',{}), childBase, engine)
+    load_contact(rep.pop('head_contact',{}), childBase, writer)
+    load_contact(rep.pop('be_contact',{}), childBase, writer)
 
-    load_person(rep.pop('legal_person'), 'legal', childBase, engine)
-    load_person(rep.pop('head_person'), 'head', childBase, engine)
+    load_person(rep.pop('legal_person'), 'legal', childBase, writer)
+    load_person(rep.pop('head_person'), 'head', childBase, writer)
     for actionField in rep.pop('action_fields'):
         rec = childBase.copy()
         rec['action_field'] = actionField
-        sl.upsert(engine, sl.get_table(engine, 'action_field'), rec,
-                  ['representative_etl_id', 'action_field'])
+        writer.upsert('action_field', rec,
+                      ['representative_etl_id', 'action_field'])
 
     for interest in rep.pop('interests'):
         rec = childBase.copy()
         rec['interest'] = interest
-        sl.upsert(engine, sl.get_table(engine, 'interest'), rec,
-                  ['representative_etl_id', 'interest'])
+        writer.upsert('interest', rec,
+                      ['representative_etl_id', 'interest'])
 
     for countryOfMember in rep.pop('country_of_members'):
         rec = childBase.copy()
         rec['country'] = countryOfMember
-        sl.upsert(engine, sl.get_table(engine, 'country_of_member'), rec,
-                  ['representative_etl_id', 'country'])
+        writer.upsert('country_of_member', rec,
+                      ['representative_etl_id', 'country'])
 
     for organisation in rep.pop('organisations'):
         rec = childBase.copy()
         rec.update(organisation)
         rec['name'] = organisation['name'].strip()
-        sl.upsert(engine, sl.get_table(engine, 'organisation'), rec,
-                  ['representative_etl_id', 'name'])
+        writer.upsert('organisation', rec,
+                      ['representative_etl_id', 'name'])
 
-    load_finances(rep.pop('fd'), childBase, engine)
+    load_finances(rep.pop('fd'), childBase, writer)
     rep['name'] = rep['original_name'].strip()
     rep['network_extracted'] = False
-    sl.upsert(engine, sl.get_table(engine, 'representative'), rep,
-              ['etl_id'])
-
-def parse(data):
-    doc = etree.fromstring(data.encode('utf-8'))
-    for rep_el in doc.findall('.//' + NS + 'interestRepresentative'):
-        yield parse_rep(rep_el)
-
-def extract_data(engine, data):
+    rep[RUN_COLUMN] = run
+    writer.upsert('representative', rep, ['etl_id'])
+
+def iter_reps(source):
+    """ Walk the register dump element by element, dropping each
+    representative (and everything before it) once it has been
+    consumed, so memory use does not grow with the file size. """
+    for _, rep_el in etree.iterparse(source, events=('end',),
+                                     tag=NS + 'interestRepresentative'):
+        yield rep_el
+        rep_el.clear()
+        while rep_el.getprevious() is not None:
+            del rep_el.getparent()[0]
+
+def fingerprint(rep_el, data):
+    """ Identify a representative's current version by its update date
+    and a hash of the serialized XML element. """
+    return '%s//%s' % (rep_el.findtext(NS + 'lastUpdateDate'),
+                       sha1(data).hexdigest())
+
+def load_fingerprints(engine):
+    table = sl.get_table(engine, 'representative')
+    if 'etl_fingerprint' not in table.c:
+        return {}
+    return dict((r['identification_code'], r['etl_fingerprint']) for r in
+                sl.distinct(engine, table, 'identification_code',
+                            'etl_fingerprint'))
+
+def not_accredited(table):
+    """ Accredited persons are maintained by regaccredit. """
+    return or_(table.c.role != 'accredited', table.c.role == None)
+
+def reactivate(engine, unchanged, run, chunk_size=500):
+    """ Stamp unchanged representatives and their current staging rows
+    with the current run without rewriting them. `unchanged` maps the register
+    status of each representative to a list of etl_ids. """
+    rep_table = sl.get_table(engine, 'representative')
+    ensure_columns(engine, rep_table, {RUN_COLUMN: sqlalchemy.BigInteger})
+    for status, etl_ids in unchanged.items():
+        for i in xrange(0, len(etl_ids), chunk_size):
+            chunk = etl_ids[i:i + chunk_size]
+            engine.execute(rep_table.update()
+                           .where(rep_table.c.etl_id.in_(chunk))
+                           .values({'status': status, RUN_COLUMN: run}))
+            for name in CHILD_TABLES:
+                table = sl.get_table(engine, name)
+                if 'representative_etl_id' not in table.c:
+                    continue
+                ensure_columns(engine, table, {RUN_COLUMN: sqlalchemy.BigInteger})
+                # rows retired by an earlier run stay retired
+                q = table.update().where(table.c.representative_etl_id.in_(chunk))
+                q = q.where(or_(table.c.status != 'inactive',
+                                table.c.status == None))
+                if name == 'person':
+                    q = q.where(not_accredited(table))
+                engine.execute(q.values({RUN_COLUMN: run}))
+
+def parse_fragment(data):
+    return parse_rep(etree.fromstring(data))
+
+def iter_changed(source, known, unchanged):
+    """ Yield (fingerprint, element, serialized element) for every
+    representative whose fingerprint differs from the known one and
+    record the others in `unchanged`. """
+    for rep_el in iter_reps(source):
+        code = rep_el.findtext(NS + 'identificationCode')
+        data = etree.tostring(rep_el, encoding='utf-8', with_tail=False)
+        fp = fingerprint(rep_el, data)
+        if known.get(code) == fp:
+            status = rep_el.findtext(NS + 'status')
+            unchanged.setdefault(status, []).append(make_etl_id(code))
+            continue
+        yield fp, rep_el, data
+
+def parse_changed(changed, workers=1, window=100):
+    """ Parse representatives in document order, either inline or by
+    handing serialized fragments to a pool of `workers` processes. The
+    next window is parsed while the previous one is being written. """
+    if workers <= 1:
+        for fp, rep_el, data in changed:
+            yield fp, parse_rep(rep_el)
+        return
+    pool = Pool(workers)
+    try:
+        pending = None
+        while True:
+            fps, fragments = [], []
+            for fp, rep_el, data in changed:
+                fps.append(fp)
+                fragments.append(data)
+                if len(fragments) >= window * workers:
+                    break
+            result = pool.map_async(parse_fragment, fragments) \
+                     if len(fragments) else None
+            if pending is not None:
+                for item in zip(pending[0], pending[1].get()):
+                    yield item
+            if result is None:
+                break
+            pending = (fps, result)
+        pool.close()
+    finally:
+        pool.terminate()
+
+def extract_data(engine, source, full=False, workers=None, run=None):
     log.info("Extracting registered interests data...")
-    for i, rep in enumerate(parse(data)):
-        load_rep(rep, engine)
-        if i % 100 == 0:
-            log.info("Extracted: %s...", i)
-
-def extract(engine):
+    if run is None:
+        run = new_run()
+    if workers is None:
+        workers = app.config.get('ETL_EXTRACT_WORKERS', 1)
+    known = {} if full else load_fingerprints(engine)
+    unchanged = {}
+    fingerprints = []
+    changed = iter_changed(source, known, unchanged)
+    with BulkWriter(engine) as writer:
+        for i, (fp, rep) in enumerate(parse_changed(changed, workers)):
+            load_rep(rep, writer, run)
+            fingerprints.append({'etl_id': rep['etl_id'],
+                                 'etl_fingerprint': fp})
+            if i % 100 == 0:
+                log.info("Extracted: %s...", i)
+    # only once all child rows are written, so that an interrupted run
+    # extracts these representatives again.
+    rep_table = sl.get_table(engine, 'representative')
+    ensure_columns(engine, rep_table, {'etl_fingerprint': sqlalchemy.Unicode})
+    bulk_update(engine, 'representative', 'etl_id', fingerprints)
+    log.info("Unchanged representatives: %s",
+             sum(len(v) for v in unchanged.values()))
+    reactivate(engine, unchanged, run)
+
+def extract(engine, full=False, workers=None):
+    """ Extract the register of interests if it changed; returns
+    whether it did. """
+    changed, fh = download.fetch(URL, force=full)
     try:
-        sl.update(engine, 'representative', {}, {'status': 'inactive'}, ensure=False)
-        sl.update(engine, 'contact', {}, {'status': 'inactive'}, ensure=False)
-        sl.update(engine, 'financial_data', {}, {'status': 'inactive'}, ensure=False)
-        sl.update(engine, 'financial_data_turnover', {}, {'status': 'inactive'}, ensure=False)
-        sl.update(engine, 'person', {}, {'status': 'inactive'}, ensure=False)
-        sl.update(engine, 'organisation', {}, {'status': 'inactive'}, ensure=False)
-        sl.update(engine, 'accreditation', {}, {'status': 'inactive'}, ensure=False)
-        sl.update(engine, 'country_of_member', {}, {'status': 'inactive'}, ensure=False)
-        sl.update(engine, 'associated_action', {}, {'status': 'inactive'}, ensure=False)
-    except sqlalchemy.exc.CompileError:
-        pass
-
-    res = requests.get(URL)
-    extract_data(engine, res.content.decode('utf-8'))
+        if not changed:
+            log.info("Register of interests is unchanged, skipping.")
+            return False
+        run = new_run()
+        extract_data(engine, fh, full=full, workers=workers, run=run)
+        finalize(engine, STATUS_TABLES, run, {'person': not_accredited})
+        download.mark_done(URL)
+        return True
+    finally:
+        fh.close()
 
 if __name__ == '__main__':
     engine = etl_engine()
@@ -374,6 +734,5 @@ if __name__ == '__main__':
         extract(engine)
     else:
         # extract from file
-        with open(sys.argv[1],'r') as fd:
-            extract_data(engine, fd.read().decode('utf-8'))
+        extract_data(engine, sys.argv[1])
 
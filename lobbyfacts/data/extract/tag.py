@@ -1,8 +1,9 @@
 from datetime import datetime
 import logging, csv
 
-import requests, sys
+import sys
 from lobbyfacts.data import sl, etl_engine
+from lobbyfacts.data.lib import download
 
 log = logging.getLogger(__name__)
 
@@ -46,9 +47,18 @@ def extract_data(engine, data):
         if i % 100 == 0:
             log.info("Extracted: %s...", i)
 
-def extract(engine):
-    res = requests.get(URL)
-    extract_data(engine, res.content)
+def extract(engine, full=False, registry_changed=True):
+    """ Extract unless both the source file and the register of
+    interests it refers to are unchanged. """
+    changed, fh = download.fetch(URL, force=full)
+    try:
+        if not changed and not registry_changed:
+            log.info("Tags are unchanged, skipping.")
+            return
+        extract_data(engine, fh.read())
+        download.mark_done(URL)
+    finally:
+        fh.close()
 
 if __name__ == '__main__':
     engine = etl_engine()
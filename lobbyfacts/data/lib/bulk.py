@@ -0,0 +1,162 @@
+import logging
+from hashlib import sha1
+from collections import OrderedDict
+
+from sqlalchemy import MetaData, Table, Column, bindparam
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+from lobbyfacts.data import sl
+
+log = logging.getLogger(__name__)
+
+# PostgreSQL refuses statements with more than 32767 bind parameters.
+MAX_PARAMS = 30000
+
+
+def _index_name(table_name, unique):
+    name = 'ux_%s_%s' % (table_name, '_'.join(unique))
+    if len(name) > 63:
+        name = 'ux_%s_%s' % (table_name[:40], sha1(name).hexdigest()[:16])
+    return name
+
+
+class BulkWriter(object):
+    """ Collect staging rows per table and write them in batches
+    instead of one ``sl.upsert`` round trip per row. On PostgreSQL a
+    batch becomes a multi-row ``INSERT ... ON CONFLICT`` on the same
+    unique key that would have been handed to ``sl.upsert``; other
+    backends fall back to row-by-row upserts on flush. """
+
+    def __init__(self, engine, batch_size=1000):
+        self.engine = engine
+        self.batch_size = batch_size
+        self.buffers = OrderedDict()
+        self.indexed = {}
+
+    def upsert(self, table_name, row, unique):
+        key = (table_name, tuple(unique))
+        buf = self.buffers.setdefault(key, [])
+        buf.append(row)
+        if len(buf) >= self.batch_size:
+            self._flush(key)
+
+    def flush(self):
+        for key in self.buffers.keys():
+            self._flush(key)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if type is None:
+            self.flush()
+
+    def _ensure_index(self, table, unique):
+        """ ON CONFLICT needs a unique index on the key columns; the
+        ETL tables are created implicitly by sqlaload, so add it the
+        first time a key is seen. """
+        key = (table.name, unique)
+        if key in self.indexed:
+            return self.indexed[key]
+        if [c for c in unique if c not in table.c]:
+            # columns will be created by sqlaload, check again later.
+            return False
+        q = self.engine.dialect.identifier_preparer.quote
+        stmt = 'CREATE UNIQUE INDEX IF NOT EXISTS %s ON %s (%s)' % (
+            q(_index_name(table.name, unique)), q(table.name),
+            ', '.join(q(c) for c in unique))
+        try:
+            self.engine.execute(stmt)
+            self.indexed[key] = True
+        except SQLAlchemyError, e:
+            log.warn("Cannot index %s on %r, writing row by row: %s",
+                     table.name, unique, e)
+            self.indexed[key] = False
+        return self.indexed[key]
+
+    def _flush(self, key):
+        rows = self.buffers.pop(key, [])
+        if not len(rows):
+            return
+        table_name, unique = key
+        table = sl.get_table(self.engine, table_name)
+        if self.engine.dialect.name != 'postgresql' or \
+                not self._ensure_index(table, unique):
+            for row in rows:
+                sl.upsert(self.engine, table, row, list(unique))
+            return
+
+        batches = OrderedDict()
+        for row in rows:
+            # NULL keys never conflict and new columns have to be
+            # created first, so leave both to sqlaload.
+            if [c for c in unique if row.get(c) is None] or \
+                    [c for c in row if c not in table.c]:
+                sl.upsert(self.engine, table, row, list(unique))
+                continue
+            columns = tuple(sorted(row.keys()))
+            batch = batches.setdefault(columns, OrderedDict())
+            batch[tuple(row[c] for c in unique)] = row
+
+        for columns, batch in batches.items():
+            values = batch.values()
+            step = max(1, MAX_PARAMS / len(columns))
+            for i in xrange(0, len(values), step):
+                stmt = pg_insert(table).values(values[i:i + step])
+                update = dict((c, stmt.excluded[c]) for c in columns
+                              if c not in unique)
+                if len(update):
+                    stmt = stmt.on_conflict_do_update(index_elements=unique,
+                                                      set_=update)
+                else:
+                    stmt = stmt.on_conflict_do_nothing(index_elements=unique)
+                self.engine.execute(stmt)
+        log.debug("Flushed %s rows to %s", len(rows), table_name)
+
+
+def ensure_columns(engine, table, types):
+    """ Create any of the columns in `types` that `table` is missing,
+    using sqlaload's schema handling on an update that matches no
+    rows. """
+    missing = dict((c, None) for c in types if c not in table.c)
+    if len(missing):
+        sl.update(engine, table, {'id': None}, missing, types=types)
+
+
+def bulk_update(engine, table_name, key, rows):
+    """ Apply many row updates matched on the `key` column. PostgreSQL
+    gets them as one ``UPDATE ... FROM`` a temporary table, other
+    backends as a single executemany. """
+    table = sl.get_table(engine, table_name)
+    batches = OrderedDict()
+    for row in rows:
+        batches.setdefault(tuple(sorted(row.keys())), []).append(row)
+    for columns, batch in batches.items():
+        values = [c for c in columns if c != key]
+        if not len(values):
+            continue
+        if engine.dialect.name == 'postgresql':
+            _pg_update(engine, table, key, columns, values, batch)
+        else:
+            stmt = table.update().where(table.c[key] == bindparam('_' + key))
+            stmt = stmt.values(dict((c, bindparam('_' + c)) for c in values))
+            engine.execute(stmt, [dict(('_' + c, r[c]) for c in columns)
+                                  for r in batch])
+        log.debug("Updated %s rows of %s", len(batch), table.name)
+
+
+def _pg_update(engine, table, key, columns, values, batch):
+    q = engine.dialect.identifier_preparer.quote
+    tmp = Table('tmp_' + table.name, MetaData(),
+                *[Column(c, table.c[c].type) for c in columns],
+                prefixes=['TEMPORARY'],
+                postgresql_on_commit='DROP')
+    with engine.begin() as conn:
+        tmp.create(conn)
+        step = max(1, MAX_PARAMS / len(columns))
+        for i in xrange(0, len(batch), step):
+            conn.execute(tmp.insert().values(batch[i:i + step]))
+        conn.execute('UPDATE %s AS t SET %s FROM %s AS s WHERE t.%s = s.%s' % (
+            q(table.name), ', '.join('%s = s.%s' % (q(c), q(c)) for c in values),
+            q(tmp.name), q(key), q(key)))
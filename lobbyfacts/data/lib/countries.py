@@ -1,8 +1,13 @@
 import csv
+import logging
 
 from lobbyfacts.core import app
 
+log = logging.getLogger(__name__)
+
 COUNTRIES = []
+INDEX = {}
+LOOKUPS = {}
 
 def get_countries():
     if not len(COUNTRIES):
@@ -14,12 +19,45 @@ def get_countries():
                 COUNTRIES.append(row)
     return COUNTRIES
 
+def _key(name):
+    return ' '.join(name.lower().split())
+
+def get_index():
+    """ Map normalised EU names, ISO2 codes and English names to their
+    rows, preferring the EU name where keys collide. Countries without
+    an ISO2 code cannot be referenced and are left out. """
+    if not len(INDEX):
+        for column in ('euname', 'iso2', 'country'):
+            for country in get_countries():
+                if not (country.get('iso2') or '').strip():
+                    continue
+                key = _key(country.get(column) or '')
+                if key:
+                    INDEX.setdefault(key, country)
+    return INDEX
+
+def lookup_country(name):
+    """ Like country_by_name, but returns None for unknown countries;
+    results, including misses, are memoized. """
+    if name is None:
+        return None
+    key = _key(name)
+    if key not in LOOKUPS:
+        LOOKUPS[key] = get_index().get(key)
+        if LOOKUPS[key] is None:
+            log.info("Unknown country: %s", name)
+    return LOOKUPS[key]
+
+def resolve_countries(names):
+    """ Resolve a whole column of country names at once, as a dict of
+    name to country row (or None). """
+    return dict((name, lookup_country(name)) for name in set(names))
+
 def country_by_name(name):
-    name = name.lower().strip()
-    for country in get_countries():
-        if country['euname'] == name:
-            return country
-    raise ValueError("%s: unknown country" % name)
+    country = lookup_country(name)
+    if country is None:
+        raise ValueError("%s: unknown country" % name.lower().strip())
+    return country
 
 
 if __name__ == '__main__':
@@ -0,0 +1,146 @@
+import os
+import json
+import gzip
+import logging
+from hashlib import sha1
+
+import requests
+
+from lobbyfacts.core import app
+
+log = logging.getLogger(__name__)
+
+
+def _cache_path(url):
+    path = app.config.get('ETL_DOWNLOAD_CACHE', 'download-cache')
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    return os.path.join(path, sha1(url).hexdigest())
+
+
+def _read_json(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'rb') as fh:
+        return json.load(fh)
+
+
+def _write_json(path, data):
+    with open(path + '.tmp', 'wb') as fh:
+        json.dump(data, fh)
+    os.rename(path + '.tmp', path)
+
+
+def _validators(res):
+    return {'etag': res.headers.get('etag'),
+            'last_modified': res.headers.get('last-modified')}
+
+
+def _discard_part(base):
+    for suffix in ('.part', '.part.json'):
+        if os.path.exists(base + suffix):
+            os.remove(base + suffix)
+
+
+def _transfer(url, base, force, chunk_size):
+    """ Fetch `url` into ``base.part``, resuming a previous partial
+    transfer with a Range request. Returns the response status. """
+    meta = _read_json(base + '.json')
+    part = _read_json(base + '.part.json')
+    # offsets have to count the bytes the server sends, not the ones
+    # left after decoding a Content-Encoding.
+    headers = {'Accept-Encoding': 'identity'}
+    if not force and os.path.exists(base + '.gz'):
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+    offset = 0
+    if os.path.exists(base + '.part'):
+        offset = os.path.getsize(base + '.part')
+    validator = part.get('etag') or part.get('last_modified')
+    if offset and validator:
+        headers['Range'] = 'bytes=%s-' % offset
+        headers['If-Range'] = validator
+
+    res = requests.get(url, headers=headers, stream=True)
+    if res.status_code == 304:
+        return res.status_code
+    if res.status_code == 416:
+        log.info("Cannot resume download of %s, starting over", url)
+        _discard_part(base)
+        return _transfer(url, base, force, chunk_size)
+    res.raise_for_status()
+    if res.status_code == 206:
+        log.info("Resuming download of %s at %s bytes", url, offset)
+        mode = 'ab'
+    else:
+        mode = 'wb'
+        validators = {}
+        if res.headers.get('content-encoding', 'identity') == 'identity':
+            validators = _validators(res)
+        _write_json(base + '.part.json', validators)
+    expected = res.headers.get('content-length')
+    received = 0
+    with open(base + '.part', mode) as fh:
+        for chunk in res.iter_content(chunk_size):
+            fh.write(chunk)
+            received += len(chunk)
+    if expected is not None and received < int(expected):
+        raise IOError("Incomplete transfer: %s of %s bytes" % (received, expected))
+    return res.status_code
+
+
+def fetch(url, force=False, retries=3, chunk_size=512 * 1024):
+    """ Download `url` through a local cache, keyed by URL, that keeps
+    the compressed payload and its ETag/Last-Modified headers. Requests
+    are conditional, interrupted transfers are resumed and the result
+    is ``(changed, fileobj)``, where `changed` is False if the payload
+    is the same one that was last marked done. """
+    base = _cache_path(url)
+    if force:
+        _discard_part(base)
+    for attempt in range(retries + 1):
+        try:
+            status = _transfer(url, base, force, chunk_size)
+            break
+        except (requests.exceptions.ConnectionError,
+                requests.exceptions.Timeout,
+                requests.exceptions.ChunkedEncodingError,
+                IOError), e:
+            if attempt == retries:
+                raise
+            log.warn("Download of %s interrupted, retrying: %s", url, e)
+
+    meta = _read_json(base + '.json')
+    if status != 304:
+        digest = sha1()
+        with open(base + '.part', 'rb') as src:
+            with gzip.open(base + '.gz.tmp', 'wb') as dst:
+                for chunk in iter(lambda: src.read(chunk_size), ''):
+                    digest.update(chunk)
+                    dst.write(chunk)
+        os.rename(base + '.gz.tmp', base + '.gz')
+        part = _read_json(base + '.part.json')
+        digest = digest.hexdigest()
+        meta = {'url': url,
+                'etag': part.get('etag'),
+                'last_modified': part.get('last_modified'),
+                'sha1': digest,
+                'done': bool(meta.get('done')) and meta.get('sha1') == digest}
+        _write_json(base + '.json', meta)
+        os.remove(base + '.part')
+        os.remove(base + '.part.json')
+    else:
+        log.info("Not modified: %s", url)
+    changed = force or not meta.get('done')
+    return changed, gzip.open(base + '.gz', 'rb')
+
+
+def mark_done(url):
+    """ Record that the cached payload for `url` has been processed, so
+    that the next unchanged download can be skipped. """
+    base = _cache_path(url)
+    meta = _read_json(base + '.json')
+    meta['done'] = True
+    _write_json(base + '.json', meta)
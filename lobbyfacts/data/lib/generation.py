@@ -0,0 +1,39 @@
+import logging
+from time import time
+
+from sqlalchemy import or_
+
+from lobbyfacts.data import sl
+
+log = logging.getLogger(__name__)
+
+RUN_COLUMN = 'etl_run'
+
+
+def new_run():
+    """ Generate an id for an extract run; rows written during the run
+    are stamped with it in the ``etl_run`` column. """
+    return int(time() * 1000)
+
+
+def finalize(engine, table_names, run, scope=None):
+    """ Derive the status of staging rows from the run that last touched
+    them: everything not stamped with `run` becomes inactive, in one
+    statement per table. Rows that are inactive already are left alone.
+    Tables without a run column are marked inactive entirely. `scope`
+    can map a table name to a function returning a clause that limits
+    the rows this run is responsible for. """
+    scope = scope or {}
+    for name in table_names:
+        table = sl.get_table(engine, name)
+        if 'status' not in table.c:
+            continue
+        q = table.update().where(or_(table.c.status != 'inactive',
+                                     table.c.status == None))
+        if name in scope:
+            q = q.where(scope[name](table))
+        if RUN_COLUMN in table.c:
+            q = q.where(or_(table.c[RUN_COLUMN] != run,
+                            table.c[RUN_COLUMN] == None))
+        res = engine.execute(q.values(status='inactive'))
+        log.info("Deactivated %s rows in %s", res.rowcount, name)
@@ -0,0 +1,96 @@
+import os
+import re
+import json
+import logging
+import tempfile
+from time import time
+from hashlib import sha1
+from urllib import urlencode
+
+from lobbyfacts.core import app
+
+log = logging.getLogger(__name__)
+
+
+class Page(object):
+    """ The parts of a response the scrapers use, as stored in the
+    cache. """
+
+    def __init__(self, content, encoding=None):
+        self.content = content
+        self.encoding = encoding
+
+    @property
+    def text(self):
+        return self.content.decode(self.encoding or 'utf-8', 'replace')
+
+
+def _root():
+    return app.config.get('ETL_PAGE_CACHE', 'page-cache')
+
+
+def _path(*parts):
+    path = os.path.join(_root(), *parts)
+    if not os.path.isdir(os.path.dirname(path)):
+        try:
+            os.makedirs(os.path.dirname(path))
+        except OSError:
+            pass
+    return path
+
+
+def _write(path, data):
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+    with os.fdopen(fd, 'wb') as fh:
+        fh.write(data)
+    os.rename(tmp, path)
+
+
+def ttl(url):
+    """ Time in seconds a cached copy of `url` stays fresh, from the
+    first matching pattern in ``ETL_PAGE_CACHE_TTL``. """
+    for pattern, seconds in app.config.get('ETL_PAGE_CACHE_TTL', []):
+        if re.search(pattern, url):
+            return seconds
+    return 0
+
+
+def get(url, fetch, params=None):
+    """ Return the page for `url`, calling `fetch` to make the request
+    if there is no fresh copy. Page bodies are stored by the hash of
+    their content, with an index entry per URL (and request params).
+    With ``ETL_PAGE_CACHE_OFFLINE`` set, pages are only replayed from
+    the cache and a miss raises ValueError. """
+    key = url
+    if params:
+        key = '%s#%s' % (url, urlencode(sorted(params.items())))
+    index = _path('index', sha1(key).hexdigest() + '.json')
+    entry = None
+    if os.path.exists(index):
+        with open(index, 'rb') as fh:
+            entry = json.load(fh)
+        obj = _path('objects', entry['hash'][:2], entry['hash'])
+        if not os.path.exists(obj):
+            entry = None
+    offline = app.config.get('ETL_PAGE_CACHE_OFFLINE', False)
+    if entry is not None and \
+            (offline or time() - entry['fetched_at'] < ttl(url)):
+        with open(obj, 'rb') as fh:
+            return Page(fh.read(), entry.get('encoding'))
+    if offline:
+        raise ValueError("Not in page cache: %s" % key)
+
+    res = fetch()
+    page = Page(res.content, res.encoding or res.apparent_encoding)
+    if res.status_code >= 400:
+        return page
+    digest = sha1(page.content).hexdigest()
+    obj = _path('objects', digest[:2], digest)
+    if not os.path.exists(obj):
+        _write(obj, page.content)
+    _write(index, json.dumps({'url': url,
+                              'params': params,
+                              'hash': digest,
+                              'encoding': page.encoding,
+                              'fetched_at': time()}))
+    return page
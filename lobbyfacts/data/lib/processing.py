@@ -1,6 +1,7 @@
 import logging
+from time import time, sleep
 from Queue import Queue
-from threading import Thread
+from threading import Thread, Lock
 
 def threaded(items, func, num_threads=5, max_queue=200):
     def queue_consumer():
@@ -25,5 +26,27 @@ def threaded(items, func, num_threads=5, max_queue=200):
     queue.join()
 
 
+class RateLimiter(object):
+    """ A token bucket shared between threads: ``wait`` blocks so that
+    calls happen at `rate` per second on average, with bursts of up to
+    `burst` calls. """
 
+    def __init__(self, rate, burst=1):
+        self.rate = float(rate)
+        self.burst = burst
+        self.tokens = burst
+        self.last = time()
+        self.lock = Lock()
 
+    def wait(self):
+        while True:
+            with self.lock:
+                now = time()
+                self.tokens = min(self.burst,
+                                  self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                delay = (1 - self.tokens) / self.rate
+            sleep(delay)
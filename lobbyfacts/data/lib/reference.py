@@ -1,4 +1,8 @@
+import os
+import json
+import gzip
 import logging
+from time import time
 
 from nomenklatura import Dataset, Entity
 
@@ -8,6 +12,11 @@ log = logging.getLogger(__name__)
 
 DATASET_CACHE = {}
 NAME_CACHE = {}
+SNAPSHOTS = {}
+MISSES = {}
+
+# cached lookup result for names the dataset does not know yet.
+NO_MATCH = object()
 
 def clean_value(value):
     return ' '.join(value.split())
@@ -19,37 +28,134 @@ def get_dataset(dataset):
         DATASET_CACHE[dataset] = Dataset(dataset,
             host=app.config.get('NOMENKLATURA_URL'),
             api_key=app.config.get('NOMENKLATURA_APIKEY'))
-        for entity in DATASET_CACHE[dataset].entities():
-            NAME_CACHE[(dataset, entity.name.lower())] = entity
-        for alias in DATASET_CACHE[dataset].aliases():
-            if alias.is_invalid:
-                NAME_CACHE[(dataset, alias.name.lower())] = \
-                    Dataset.Invalid({'dataset': alias.dataset, 'name': alias.name})
-            elif alias.is_matched:
-                NAME_CACHE[(dataset, alias.name.lower())] = \
-                    Entity(DATASET_CACHE[dataset], alias.entity)
+        for name, res in fetch_names(DATASET_CACHE[dataset]).items():
+            NAME_CACHE[(dataset, name)] = res
     return DATASET_CACHE[dataset]
 
 
+def fetch_names(ds):
+    """ Map each lower-cased entity and alias name of the dataset to
+    its canonical name, or to None for names marked invalid. """
+    names = {}
+    for entity in ds.entities():
+        names[entity.name.lower()] = entity.name
+    for alias in ds.aliases():
+        if alias.is_invalid:
+            names[alias.name.lower()] = None
+        elif alias.is_matched:
+            names[alias.name.lower()] = Entity(ds, alias.entity).name
+    return names
+
+
+def _path(dataset, suffix):
+    path = app.config.get('NOMENKLATURA_SNAPSHOT', 'reference-snapshot')
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    return os.path.join(path, dataset + suffix)
+
+
+def get_snapshot(dataset):
+    """ The name index from the local snapshot of `dataset`, or None if
+    no snapshot has been made yet. """
+    if dataset not in SNAPSHOTS:
+        path = _path(dataset, '.json.gz')
+        if os.path.exists(path):
+            with gzip.open(path, 'rb') as fh:
+                SNAPSHOTS[dataset] = json.load(fh)['names']
+            log.info("Loaded %s names of %s from %s",
+                     len(SNAPSHOTS[dataset]), dataset, path)
+        else:
+            log.warn("No snapshot of %s, querying nomenklatura instead. "
+                     "Run refresh_reference to create one.", dataset)
+            SNAPSHOTS[dataset] = None
+    return SNAPSHOTS[dataset]
+
+
+def _plain(context):
+    return dict((k, v) for k, v in context.items()
+                if v is None or isinstance(v, (basestring, int, float, bool)))
+
+
+def _lookup(dataset, value, context, readonly):
+    value = clean_value(value)
+    names = get_snapshot(dataset)
+    if names is not None:
+        if value.lower() in names:
+            return names[value.lower()]
+        if not readonly:
+            MISSES.setdefault(dataset, {})[value] = _plain(context)
+        return NO_MATCH
+    try:
+        ds = get_dataset(dataset)
+        if (dataset, value.lower()) in NAME_CACHE:
+            return NAME_CACHE[(dataset, value.lower())]
+        return ds.lookup(value, context=context, readonly=readonly).name
+    except Dataset.Invalid:
+        return None
+    except Dataset.NoMatch:
+        return NO_MATCH
+
+
 def canonical(dataset, value, context={}, readonly=False):
     lvalue = value.lower()
     if not (dataset, lvalue) in NAME_CACHE:
-        try:
-            ds = get_dataset(dataset)
-            value = clean_value(value)
-            v = ds.lookup(value, context=context,
-                          readonly=readonly)
-            NAME_CACHE[(dataset, lvalue)] = v
-        except Dataset.Invalid, ex:
-            NAME_CACHE[(dataset, lvalue)] = ex
-        except Dataset.NoMatch, ex:
-            NAME_CACHE[(dataset, lvalue)] = ex
+        NAME_CACHE[(dataset, lvalue)] = _lookup(dataset, value, context,
+                                                readonly)
 
     res = NAME_CACHE[(dataset, lvalue)]
     log.debug(" - %s :> %s", value, res)
-    if isinstance(res, Dataset.Invalid):
-        return None
-    if isinstance(res, Dataset.NoMatch):
+    if res is NO_MATCH:
         raise ValueError("%s: no match." % value)
-    return res.name
+    return res
+
+
+def load_misses(dataset):
+    path = _path(dataset, '.misses.json')
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'rb') as fh:
+        return json.load(fh)
+
+
+def save_misses():
+    """ Add the names that were not in the snapshot to the review batch
+    that the next refresh sends to nomenklatura. """
+    for dataset, misses in MISSES.items():
+        batch = load_misses(dataset)
+        batch.update(misses)
+        path = _path(dataset, '.misses.json')
+        with open(path + '.tmp', 'wb') as fh:
+            json.dump(batch, fh)
+        os.rename(path + '.tmp', path)
+        log.info("%s names of %s queued for review in %s", len(batch),
+                 dataset, path)
+    MISSES.clear()
+
+
+def refresh(dataset):
+    """ Submit the queued misses for review and download a new snapshot
+    of all entities and aliases of `dataset`. """
+    ds = Dataset(dataset,
+        host=app.config.get('NOMENKLATURA_URL'),
+        api_key=app.config.get('NOMENKLATURA_APIKEY'))
+    misses = load_misses(dataset)
+    for value, context in misses.items():
+        try:
+            ds.lookup(value, context=context)
+        except (Dataset.Invalid, Dataset.NoMatch):
+            pass
+    log.info("Submitted %s names of %s for review", len(misses), dataset)
 
+    names = fetch_names(ds)
+    path = _path(dataset, '.json.gz')
+    with gzip.open(path + '.tmp', 'wb') as fh:
+        json.dump({'dataset': dataset, 'created_at': time(),
+                   'names': names}, fh)
+    os.rename(path + '.tmp', path)
+    if os.path.exists(_path(dataset, '.misses.json')):
+        os.remove(_path(dataset, '.misses.json'))
+    log.info("Saved %s names of %s to %s", len(names), dataset, path)
+    SNAPSHOTS.pop(dataset, None)
+    for key in NAME_CACHE.keys():
+        if key[0] == dataset:
+            del NAME_CACHE[key]
@@ -1,5 +1,8 @@
+import json
 import logging
+from hashlib import sha1
 from pprint import pprint
+from multiprocessing import Pool
 
 from lobbyfacts.core import db
 from lobbyfacts.data import sl, etl_engine
@@ -10,25 +13,86 @@ from lobbyfacts.model import CountryMembership, ActionField, AssociatedAction
 from lobbyfacts.model import Interest, AssociatedInterest, CustomIncome, Contact
 from lobbyfacts.data.load.util import to_integer, to_float, upsert_person
 from lobbyfacts.data.load.util import upsert_person, upsert_organisation, upsert_entity, upsert_tag
+from lobbyfacts.data.load.util import LoadContext
+from lobbyfacts.data.lib.bulk import BulkWriter
+from lobbyfacts.data.lib.generation import RUN_COLUMN
+from lobbyfacts.model.revision import RevisionedMixIn
 from lobbyfacts.core import app
 from datetime import datetime
 
 log = logging.getLogger(__name__)
 
-def upsert_category(id, name, parent=None):
+def upsert_category(id, name, parent=None, cache=None):
     data = {'id': id, 'name': name, 'parent': parent}
-    category = Category.by_id(id)
+    category = cache.categories.get(id) if cache else Category.by_id(id)
     if category is None:
         category = Category.create(data)
-        db.session.commit()
+        if cache:
+            cache.categories[id] = category
     else:
         category.update(data)
     return category
 
-def load_representative(engine, rep):
+def upsert_action_field(action, cache=None):
+    af = cache.action_fields.get(action) if cache else ActionField.by_action(action)
+    if af is None:
+        af = ActionField.create({'action': action})
+        if cache:
+            cache.action_fields[action] = af
+    return af
+
+def upsert_interest(interest, cache=None):
+    i = cache.interests.get(interest) if cache else Interest.by_interest(interest)
+    if i is None:
+        i = Interest.create({'interest': interest})
+        if cache:
+            cache.interests[interest] = i
+    return i
+
+# staging columns that change without the data changing.
+IGNORE = set(['id', RUN_COLUMN])
+
+CHILD_TABLES = ['person', 'contact', 'financial_data',
+                'financial_data_custom_source', 'financial_data_turnover',
+                'organisation', 'country_of_member', 'action_field',
+                'interest']
+
+def group_rows(engine, table_name, column, keys):
+    """ All rows of an ETL table with `column` in `keys`, as lists
+    grouped by that column. """
+    table = sl.get_table(engine, table_name)
+    groups = {}
+    if column not in table.c or not len(keys):
+        return groups
+    q = table.select().where(table.c[column].in_(keys))
+    for row in engine.execute(q.order_by(table.c.id)):
+        row = dict(row.items())
+        groups.setdefault(row[column], []).append(row)
+    return groups
+
+def prefetch(engine, reps):
+    """ Read the ETL child rows of a batch of representatives with one
+    query per table. """
+    etl_ids = [r['etl_id'] for r in reps]
+    children = {}
+    for table_name in CHILD_TABLES:
+        children[table_name] = group_rows(engine, table_name,
+                                          'representative_etl_id', etl_ids)
+    children['tags'] = group_rows(engine, 'tags', 'representative_id',
+                                  [r['id'] for r in reps])
+    tag_ids = set(l['tag_id'] for ls in children['tags'].values() for l in ls)
+    children['tag'] = group_rows(engine, 'tag', 'id', list(tag_ids))
+    return children
+
+def load_representative(engine, rep, cache=None, children=None):
+    if children is None:
+        children = prefetch(engine, [rep])
+    rows = lambda table_name: children[table_name].get(rep['etl_id'], [])
+    country_by_code = cache.countries.get if cache else Country.by_code
     entity = upsert_entity(rep.get('canonical_name'),
                 name=rep.get('original_name'),
                 suffix=rep.get('name_suffix'),
+                cache=cache,
                 acronym=rep.get('acronym'))
     assert entity is not None, entity
     assert entity.id is not None, entity
@@ -41,19 +105,24 @@ def load_representative(engine, rep):
     rep['members'] = to_integer(rep['members'])
     rep['number_of_natural_persons'] = to_integer(rep['number_of_natural_persons'])
 
-    if rep.get('main_category'):
+    # categories that could not be coded have no id and are not linked
+    main_category, sub_category = None, None
+    if rep.get('main_category') and rep.get('main_category_id') is not None:
         main_category = upsert_category(rep.get('main_category_id'),
-                                        rep.get('main_category'))
-        rep['main_category'] = main_category
-        if rep.get('sub_category'):
-            rep['sub_category'] = upsert_category(rep.get('sub_category_id'),
-                                                  rep.get('sub_category'),
-                                                  main_category)
+                                        rep.get('main_category'),
+                                        cache=cache)
+        if rep.get('sub_category') and \
+                rep.get('sub_category_id') is not None:
+            sub_category = upsert_category(rep.get('sub_category_id'),
+                                           rep.get('sub_category'),
+                                           main_category,
+                                           cache=cache)
+    rep['main_category'] = main_category
+    rep['sub_category'] = sub_category
 
     accreditations = []
-    for person_data in sl.find(engine, sl.get_table(engine, 'person'),
-            representative_etl_id=rep['etl_id']):
-        person = upsert_person(person_data)
+    for person_data in rows('person'):
+        person = upsert_person(person_data, cache=cache)
         if person_data.get('role') == 'head':
             rep['head'] = person
         if person_data.get('role') == 'legal':
@@ -67,8 +136,8 @@ def load_representative(engine, rep):
     else:
         representative.update(rep)
 
-    for contact_data in sl.find(engine, sl.get_table(engine, 'contact'),
-            representative_etl_id=rep['etl_id'], status='active'):
+    for contact_data in rows('contact'):
+        if contact_data.get('status') != 'active': continue
         if len([x for x in contact_data.values() if x])<7: continue
         contact_ = {
             'town': contact_data['town'],
@@ -78,7 +147,7 @@ def load_representative(engine, rep):
             'lat': to_float(contact_data['lat']),
             'lon': to_float(contact_data['lon']),
             'phone': " ".join((contact_data.get('indic_phone') or '', contact_data.get('phone') or '')).strip(),
-            'country': Country.by_code(contact_data['country_code']),
+            'country': country_by_code(contact_data['country_code']),
             }
 
         if contact_data['type'] == 'head':
@@ -104,8 +173,7 @@ def load_representative(engine, rep):
         else:
             accreditation.update(data_)
 
-    for fd in sl.find(engine, sl.get_table(engine, 'financial_data'),
-            representative_etl_id=rep['etl_id']):
+    for fd in rows('financial_data'):
         fd['turnover_min'] = to_integer(fd.get('turnover_min'))
         fd['turnover_max'] = to_integer(fd.get('turnover_max'))
         fd['turnover_absolute'] = to_integer(fd.get('turnover_absolute'))
@@ -134,8 +202,8 @@ def load_representative(engine, rep):
         else:
             financial_data.update(fd)
 
-        for src_ in sl.find(engine, sl.get_table(engine, 'financial_data_custom_source'),
-                representative_etl_id=rep['etl_id'], financial_data_etl_id=fd['etl_id']):
+        for src_ in rows('financial_data_custom_source'):
+            if src_.get('financial_data_etl_id') != fd['etl_id']: continue
             src_['financial_data'] = financial_data
             src_['amount'] = to_integer(src_.get('amount'))
             src = CustomIncome.by_fdn(financial_data, src_['name'])
@@ -144,12 +212,13 @@ def load_representative(engine, rep):
             else:
                 src.update(src_)
 
-        for turnover_ in sl.find(engine, sl.get_table(engine, 'financial_data_turnover'),
-                representative_etl_id=rep['etl_id'], financial_data_etl_id=fd['etl_id']):
+        for turnover_ in rows('financial_data_turnover'):
+            if turnover_.get('financial_data_etl_id') != fd['etl_id']: continue
             #if turnover_.get('etl_clean') is False:
             #    continue
             turnover_['entity'] = upsert_entity(turnover_.get('canonical_name'),
-                                                turnover_.get('name'))
+                                                turnover_.get('name'),
+                                                cache=cache)
             assert turnover_['entity'] is not None, turnover_['entity']
             turnover_['financial_data'] = financial_data
             turnover_['min'] = to_integer(turnover_.get('min'))
@@ -160,12 +229,11 @@ def load_representative(engine, rep):
             else:
                 turnover.update(turnover_)
 
-    for org in sl.find(engine, sl.get_table(engine, 'organisation'),
-            representative_etl_id=rep['etl_id']):
+    for org in rows('organisation'):
         #if org.get('etl_clean') is False:
         #    continue
         org['number_of_members'] = to_integer(org['number_of_members'])
-        organisation = upsert_organisation(org)
+        organisation = upsert_organisation(org, cache=cache)
         omdata = {'representative': representative,
                   'status': org.get('status'),
                   'organisation': organisation}
@@ -175,27 +243,22 @@ def load_representative(engine, rep):
         else:
             om.update(omdata)
 
-    for country_ in sl.find(engine, sl.get_table(engine, 'country_of_member'),
-            representative_etl_id=rep['etl_id']):
+    for country_ in rows('country_of_member'):
         if not country_.get('country_code'): continue
         #if country_.get('etl_clean') is False:
         #    continue
         cdata = {'representative': representative,
                  'status': country_.get('status'),
-                 'country': Country.by_code(country_.get('country_code'))}
+                 'country': country_by_code(country_.get('country_code'))}
         cm = CountryMembership.by_rpc(representative, cdata.get('country'))
         if cm is None:
             cm = CountryMembership.create(cdata)
         else:
             cm.update(cdata)
 
-    for action_ in sl.find(engine, sl.get_table(engine, 'action_field'),
-            representative_etl_id=rep['etl_id']):
+    for action_ in rows('action_field'):
         if not action_.get('action_field'): continue
-        af = ActionField.by_action(action_.get('action_field'))
-        if af is None:
-            af = ActionField.create({'action': action_.get('action_field')})
-            db.session.commit()
+        af = upsert_action_field(action_.get('action_field'), cache)
         adata = {'representative': representative,
                  'status': action_.get('status'),
                  'action': af}
@@ -203,17 +266,12 @@ def load_representative(engine, rep):
         am = AssociatedAction.by_rpa(representative, af)
         if am is None:
             am = AssociatedAction.create(adata)
-            db.session.commit()
         else:
             am.update(adata)
 
-    for interest_ in sl.find(engine, sl.get_table(engine, 'interest'),
-            representative_etl_id=rep['etl_id']):
+    for interest_ in rows('interest'):
         if not interest_.get('interest'): continue
-        i = Interest.by_interest(interest_.get('interest'))
-        if i is None:
-            i = Interest.create({'interest': interest_.get('interest')})
-            db.session.commit()
+        i = upsert_interest(interest_.get('interest'), cache)
         adata = {'representative': representative,
                  'status': action_.get('status'),
                  'interest': i}
@@ -221,28 +279,233 @@ def load_representative(engine, rep):
         ai = AssociatedInterest.by_rpi(representative, i)
         if ai is None:
             ai = AssociatedInterest.create(adata)
-            db.session.commit()
         else:
             ai.update(adata)
 
-    for taglink in sl.find(engine, sl.get_table(engine, 'tags'),
-            representative_id=rep['id']):
-        etltag=sl.find_one(engine, sl.get_table(engine, 'tag'), id=taglink['tag_id'])
-        tag = upsert_tag(etltag['tag'])
+    for taglink in children['tags'].get(rep['id'], []):
+        etltag = children['tag'][taglink['tag_id']][0]
+        tag = upsert_tag(etltag['tag'], cache=cache)
         if not tag in representative.tags:
             representative.tags.append(tag)
-    db.session.commit()
 
 def external_url_handler(error, endpoint, values):
     return ''
 
-def load(engine):
-    for i, rep in enumerate(sl.all(engine, sl.get_table(engine, 'representative'))):
-        log.info("Loading(%s): %s", i, rep.get('name'))
-        #if rep['etl_clean'] is False:
-        #    log.debug("Skipping!")
-        #    continue
-        load_representative(engine, rep)
+def checksum(rep, children):
+    """ Fingerprint of a representative's staging data, including all
+    of its child rows, that changes whenever a reload would. """
+    parts = [dict((k, v) for k, v in rep.items() if k not in IGNORE)]
+    for table_name in CHILD_TABLES:
+        rows = children[table_name].get(rep['etl_id'], [])
+        parts.append(sorted(json.dumps(dict((k, v) for k, v in r.items()
+                                            if k not in IGNORE),
+                                       sort_keys=True, default=unicode)
+                            for r in rows))
+    tags = children['tags'].get(rep['id'], [])
+    parts.append(sorted(children['tag'][l['tag_id']][0]['tag'] for l in tags))
+    return sha1(json.dumps(parts, sort_keys=True, default=unicode)).hexdigest()
+
+def load_state(engine):
+    """ The update date and checksum of each representative as it was
+    last loaded into production. """
+    table = sl.get_table(engine, 'load_state')
+    if 'etl_id' not in table.c:
+        return {}
+    return dict((r['etl_id'], (r['last_update_date'], r['checksum']))
+                for r in sl.all(engine, table))
+
+def load_chunk(engine, reps, cache, children):
+    """ Load a chunk of representatives in one transaction. If it
+    fails, the chunk is rolled back and loaded again one representative
+    per transaction, so that a bad record only loses itself. Returns
+    the representatives that were loaded. """
+    try:
+        for rep in reps:
+            load_representative(engine, dict(rep), cache, children)
+        db.session.commit()
+        return reps
+    except Exception, e:
+        db.session.rollback()
+        cache.reset()
+        if len(reps) == 1:
+            log.exception(e)
+            return []
+        log.warn("Chunk of %s failed, retrying one by one: %s", len(reps), e)
+    loaded = []
+    for rep in reps:
+        try:
+            load_representative(engine, dict(rep), cache, children)
+            db.session.commit()
+            loaded.append(rep)
+        except Exception, e:
+            db.session.rollback()
+            cache.reset()
+            log.exception("Cannot load %s: %s", rep.get('identification_code'), e)
+    return loaded
+
+def select(reps, children, state, stats, full=False):
+    """ The representatives of a batch that are new or whose staging
+    data has changed since they were last loaded (all of them with
+    `full`), and the checksums of the batch. """
+    todo, sums = [], {}
+    for rep in reps:
+        sums[rep['etl_id']] = checksum(rep, children)
+        last = state.get(rep['etl_id'])
+        if last is None:
+            stats['new'] += 1
+        elif last != (rep.get('last_update_date'), sums[rep['etl_id']]):
+            stats['changed'] += 1
+        elif not full:
+            continue
+        todo.append(rep)
+    stats['seen'] += len(reps)
+    stats['todo'] += len(todo)
+    return todo, sums
+
+def load_selected(engine, reps, children, cache, sums, stats):
+    chunk_size = app.config.get('ETL_LOAD_CHUNK', 200)
+    with BulkWriter(engine) as writer:
+        for i in xrange(0, len(reps), chunk_size):
+            chunk = reps[i:i + chunk_size]
+            for rep in chunk:
+                log.info("Loading(%s): %s", stats['loaded'], rep.get('name'))
+                #if rep['etl_clean'] is False:
+                #    log.debug("Skipping!")
+                #    continue
+            loaded = load_chunk(engine, chunk, cache, children)
+            stats['loaded'] += len(loaded)
+            stats['failed'] += len(chunk) - len(loaded)
+            for rep in loaded:
+                writer.upsert('load_state', {
+                    'etl_id': rep['etl_id'],
+                    'last_update_date': rep.get('last_update_date'),
+                    'checksum': sums[rep['etl_id']],
+                    'loaded_at': datetime.utcnow()}, ['etl_id'])
+
+def prepare_shared(reps, children, cache):
+    """ Create or update the rows that several representatives can
+    refer to: categories, action fields, interests, tags and the
+    entities, persons and organisations named in the staging data. Run
+    serially before a parallel load, so that workers only find these. """
+    for rep in reps:
+        rows = lambda table_name: children[table_name].get(rep['etl_id'], [])
+        upsert_entity(rep.get('canonical_name'), name=rep.get('original_name'),
+                      suffix=rep.get('name_suffix'), cache=cache,
+                      acronym=rep.get('acronym'))
+        if rep.get('main_category') and \
+                rep.get('main_category_id') is not None:
+            main_category = upsert_category(rep.get('main_category_id'),
+                                            rep.get('main_category'),
+                                            cache=cache)
+            if rep.get('sub_category') and \
+                    rep.get('sub_category_id') is not None:
+                upsert_category(rep.get('sub_category_id'),
+                                rep.get('sub_category'), main_category,
+                                cache=cache)
+        for person_data in rows('person'):
+            upsert_person(dict(person_data), cache=cache)
+        for data in rows('financial_data_turnover'):
+            upsert_entity(data.get('canonical_name'), data.get('name'),
+                          cache=cache)
+        for org in rows('organisation'):
+            org = dict(org)
+            org['number_of_members'] = to_integer(org['number_of_members'])
+            upsert_organisation(org, cache=cache)
+        for action_ in rows('action_field'):
+            if action_.get('action_field'):
+                upsert_action_field(action_.get('action_field'), cache)
+        for interest_ in rows('interest'):
+            if interest_.get('interest'):
+                upsert_interest(interest_.get('interest'), cache)
+        for taglink in children['tags'].get(rep['id'], []):
+            tag = upsert_tag(children['tag'][taglink['tag_id']][0]['tag'],
+                             cache=cache)
+            db.session.add(tag)
+    db.session.commit()
+
+def partition(code, workers):
+    if isinstance(code, unicode):
+        code = code.encode('utf-8')
+    return int(sha1(code).hexdigest(), 16) % workers
+
+def load_partition(args):
+    """ Worker process of a parallel load: load one partition of the
+    selected representatives with its own connections and session. """
+    reps, sums, batch_size = args
+    db.session.remove()
+    db.engine.dispose()
+    engine = etl_engine()
+    cache = LoadContext(prepared=True)
+    stats = dict(seen=0, new=0, changed=0, todo=0, loaded=0, failed=0)
+    RevisionedMixIn.defer_flush = True
+    for i in xrange(0, len(reps), batch_size):
+        batch = reps[i:i + batch_size]
+        load_selected(engine, batch, prefetch(engine, batch), cache, sums,
+                      stats)
+    db.session.remove()
+    return stats
+
+def iter_batches(engine, batch_size):
+    batch = []
+    for rep in sl.all(engine, sl.get_table(engine, 'representative')):
+        batch.append(rep)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if len(batch):
+        yield batch
+
+def load(engine, full=False, dry_run=False, workers=None, batch_size=500):
+    """ Load new and changed representatives into production; with
+    `full`, reload all of them. A dry run only reports how many
+    representatives would be loaded. With more than one worker, the
+    representatives are partitioned by identification code across
+    worker processes after the shared rows have been created. """
+    workers = workers or app.config.get('ETL_LOAD_WORKERS', 1)
+    cache = LoadContext() if not dry_run else None
+    state = load_state(engine)
+    stats = dict(seen=0, new=0, changed=0, todo=0, loaded=0, failed=0)
+    partitions = [([], {}) for i in range(workers)]
+    RevisionedMixIn.defer_flush = True
+    try:
+        for batch in iter_batches(engine, batch_size):
+            children = prefetch(engine, batch)
+            todo, sums = select(batch, children, state, stats, full)
+            if dry_run:
+                continue
+            if workers == 1:
+                load_selected(engine, todo, children, cache, sums, stats)
+                continue
+            prepare_shared(todo, children, cache)
+            for rep in todo:
+                reps, sums_ = partitions[partition(rep['identification_code'],
+                                                   workers)]
+                reps.append(rep)
+                sums_[rep['etl_id']] = sums[rep['etl_id']]
+        if workers > 1 and not dry_run:
+            db.session.remove()
+            db.engine.dispose()
+            pool = Pool(workers)
+            try:
+                results = pool.map(load_partition,
+                                   [(r, s, batch_size) for r, s in partitions])
+            finally:
+                pool.close()
+                pool.join()
+            for result in results:
+                stats['loaded'] += result['loaded']
+                stats['failed'] += result['failed']
+    finally:
+        RevisionedMixIn.defer_flush = False
+    if dry_run:
+        log.warn("Dry run: would load %s of %s representatives (%s new, "
+                 "%s changed)", stats['todo'], stats['seen'], stats['new'],
+                 stats['changed'])
+    else:
+        log.info("Loaded %s of %s representatives (%s new, %s changed, "
+                 "%s failed)", stats['loaded'], stats['seen'], stats['new'],
+                 stats['changed'], stats['failed'])
+    return stats
 
 if __name__ == '__main__':
     # init flask
@@ -1,9 +1,40 @@
 import logging
 
+from lobbyfacts.core import db
 from lobbyfacts.model import Entity, Person, Organisation, Tag
+from lobbyfacts.model import Category, Country, ActionField, Interest
 
 log = logging.getLogger(__name__)
 
+
+class LoadContext(object):
+    """ Lookup dictionaries of the small reference tables that every
+    representative refers to. They are loaded once per run and the
+    loader adds, renames and removes objects as it goes. A `prepared`
+    context belongs to a parallel worker: persons and organisations
+    have been written before the workers started, so it only looks
+    them up. """
+
+    def __init__(self, prepared=False):
+        self.prepared = prepared
+        self.reset()
+
+    def reset(self):
+        self.categories = self._index(Category.all(), 'id')
+        self.countries = self._index(Country.all(), 'code')
+        self.action_fields = self._index(ActionField.all(), 'action')
+        self.interests = self._index(Interest.all(), 'interest')
+        self.tags = self._index(db.session.query(Tag), 'tag')
+        self.entities = self._index(Entity.all(), 'name')
+        log.info("Loader context: %s entities, %s tags", len(self.entities),
+                 len(self.tags))
+
+    def _index(self, q, attr):
+        index = {}
+        for obj in q:
+            index.setdefault(getattr(obj, attr), obj)
+        return index
+
 def to_integer(val):
     if val is None:
         return None
@@ -20,47 +51,63 @@ def to_float(val):
     except ValueError:
         return None
 
-def upsert_entity(canonical_name, name=None, suffix=None, **kw):
+def upsert_entity(canonical_name, name=None, suffix=None, cache=None, **kw):
     if canonical_name is None or not len(canonical_name.strip()):
         canonical_name = name
     if suffix is not None and len(suffix):
         canonical_name = "%s %s" % (canonical_name, suffix)
     kw['name'] = canonical_name
-    entity = Entity.by_name(canonical_name)
+    by_name = cache.entities.get if cache else Entity.by_name
+    entity = by_name(canonical_name)
     if canonical_name != name:
-        entity_ = Entity.by_name(name)
+        entity_ = by_name(name)
         if entity_ is not None:
             if entity is None:
                 entity = entity_
                 entity_.update(kw)
+                if cache:
+                    cache.entities.pop(name, None)
+                    cache.entities[entity.name] = entity
             else:
                 entity_.delete()
+                if cache:
+                    cache.entities.pop(name, None)
     if entity is None:
         entity = Entity.create(kw)
+        if cache:
+            cache.entities[entity.name] = entity
     return entity
 
-def upsert_person(data):
-    entity = upsert_entity(data.get('canonical_name'), data.get('name'))
+def upsert_person(data, cache=None):
+    entity = upsert_entity(data.get('canonical_name'), data.get('name'),
+                           cache=cache)
     data['entity'] = entity
     person = Person.by_name_pos(entity.name, data.get('position'))
+    if cache is not None and cache.prepared:
+        return person
     if person is None:
         person = Person.create(data)
     else:
         person.update(data)
     return person
 
-def upsert_organisation(data):
-    entity = upsert_entity(data.get('canonical_name'), data.get('name'))
+def upsert_organisation(data, cache=None):
+    entity = upsert_entity(data.get('canonical_name'), data.get('name'),
+                           cache=cache)
     data['entity'] = entity
     organisation = Organisation.by_name(entity.name)
+    if cache is not None and cache.prepared:
+        return organisation
     if organisation is None:
         organisation = Organisation.create(data)
     else:
         organisation.update(data)
     return organisation
 
-def upsert_tag(data, **kw):
-    tag = Tag.by_tag(data)
+def upsert_tag(data, cache=None, **kw):
+    tag = cache.tags.get(data) if cache else Tag.by_tag(data)
     if tag is None:
         tag = Tag(tag=data)
+        if cache:
+            cache.tags[data] = tag
     return tag
@@ -1,6 +1,9 @@
 import logging
 
+from sqlalchemy import BigInteger, case, select, and_
+
 from lobbyfacts.data import sl, etl_engine
+from lobbyfacts.data.lib.bulk import ensure_columns
 
 log = logging.getLogger(__name__)
 
@@ -41,40 +44,40 @@ newsubcats = { u'Other organisations':u'Other in house lobbyists',
                u'Trade and business associations': u'Trade and business organisations',
              }
 
-def remap_categories(engine):
-    table = sl.get_table(engine, 'representative')
-    for cat in sl.distinct(engine, table, 'main_category'):
-        c=newcats.get(cat['main_category'])
-        if c:
-           sl.update(engine, 'representative', {'main_category': cat['main_category']}, {'main_category': c}, ensure=False)
+def _case(column, mapping, default):
+    if not len(mapping):
+        return default
+    return case([(column == k, v) for k, v in mapping.items()], else_=default)
 
-def remap_subcategories(engine):
-    table = sl.get_table(engine, 'representative')
-    for cat in sl.distinct(engine, table, 'sub_category'):
-        c=newsubcats.get(cat['sub_category'])
-        if c:
-           sl.update(engine, 'representative', {'sub_category': cat['sub_category']}, {'sub_category': c}, ensure=False)
+def _codes(codes, renames):
+    """ Codes keyed on both the current and the outdated names, since
+    the SET clauses of one UPDATE all see the old column values. """
+    codes = dict(codes)
+    for old, new in renames.items():
+        codes[old] = codes[new]
+    return codes
 
 def code_categories(engine):
+    """ Remap outdated category names and set the category codes in a
+    single UPDATE on representative. """
     table = sl.get_table(engine, 'representative')
-    for cat in sl.distinct(engine, table, 'main_category'):
-        if not cat['main_category']: continue
-        cat['main_category_id'] = CATEGORIES[cat['main_category']]
-        sl.upsert(engine, table, cat, ['main_category'])
-
-def code_subcategories(engine):
-    table = sl.get_table(engine, 'representative')
-    for cat in sl.distinct(engine, table, 'sub_category'):
-        if not cat['sub_category']: continue
-        cat['sub_category_id'] = SUBCATEGORIES.get(cat['sub_category'])
-        sl.upsert(engine, table, cat, ['sub_category'])
+    ensure_columns(engine, table, {'main_category_id': BigInteger,
+                                   'sub_category_id': BigInteger})
+    main, sub = table.c.main_category, table.c.sub_category
+    engine.execute(table.update().values(
+        main_category=_case(main, newcats, main),
+        sub_category=_case(sub, newsubcats, sub),
+        main_category_id=_case(main, _codes(CATEGORIES, newcats), None),
+        sub_category_id=_case(sub, _codes(SUBCATEGORIES, newsubcats), None)))
+    for name, column in (('main_category', main), ('sub_category', sub)):
+        q = select([column], distinct=True).where(and_(
+            column != None, table.c[name + '_id'] == None))
+        for row in engine.execute(q):
+            log.warn("Unknown %s: %s", name, row[0])
 
 def transform(engine):
     log.info("Performing micro-transforms...")
-    remap_categories(engine)
-    remap_subcategories(engine)
     code_categories(engine)
-    code_subcategories(engine)
 
 if __name__ == '__main__':
     engine = etl_engine()
@@ -1,31 +1,47 @@
 import logging
 
+from sqlalchemy import UnicodeText
+
 from lobbyfacts.data import sl, etl_engine
+from lobbyfacts.data.lib.bulk import bulk_update, ensure_columns
 
 log = logging.getLogger(__name__)
 
-def dedup_fields(engine, field):
-    table = sl.get_table(engine, 'representative')
-    seen=set([])
-    for n, rep in enumerate(sl.all(engine, table)):
-        if n % 100 == 0:
-            print n, 'done'
-        if not rep[field] or not rep[field].strip() or rep[field] in seen: continue
-        seen.update(rep[field])
-        others = list(sl.find(engine, table, **{field: rep[field]}))
-        if len(others) > 1:
-            log.info("Duplicates for: %s", rep['name'])
-            for i, re in enumerate(others):
-                if re == rep: continue
-                text = "(Duplicate %s)" % (i+1)
-                sl.upsert(engine, table,
-                    {'name_suffix': text,
-                     'identification_code': re['identification_code']},
-                    ['identification_code'])
+FIELDS = ['name', 'canonical_name']
+
+def group_suffixes(reps, field):
+    """ Map the ids of all but the first representative (by id) of each
+    group sharing `field` to their "(Duplicate n)" suffix. """
+    groups = {}
+    for rep in reps:
+        value = rep.get(field)
+        if value and value.strip():
+            groups.setdefault(value, []).append(rep)
+    suffixes = {}
+    for value, group in groups.items():
+        if len(group) < 2:
+            continue
+        log.info("Duplicates for: %s", group[0]['name'])
+        for i, rep in enumerate(group[1:], 1):
+            suffixes[rep['id']] = "(Duplicate %s)" % (i+1)
+    return suffixes
 
 def transform(engine):
-    dedup_fields(engine, 'name')
-    dedup_fields(engine, 'canonical_name')
+    """ Mark duplicate representatives by name and canonical name in one
+    pass; duplicates of a canonical name take precedence. """
+    table = sl.get_table(engine, 'representative')
+    reps = sorted(sl.all(engine, table), key=lambda r: r['id'])
+    suffixes = {}
+    for field in FIELDS:
+        if field in table.c:
+            suffixes.update(group_suffixes(reps, field))
+    ensure_columns(engine, table, {'name_suffix': UnicodeText})
+    changes = [{'id': rep['id'], 'name_suffix': suffixes.get(rep['id'])}
+               for rep in reps
+               if rep.get('name_suffix') != suffixes.get(rep['id'])]
+    log.info("Duplicate representatives: %s (%s changed)", len(suffixes),
+             len(changes))
+    bulk_update(engine, 'representative', 'id', changes)
 
 if __name__ == '__main__':
     engine = etl_engine()
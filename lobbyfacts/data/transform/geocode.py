@@ -1,41 +1,166 @@
+import csv
 import logging
+from hashlib import sha1
+from datetime import datetime
+from threading import Lock
 import requests
 
-from pprint import pprint
+from sqlalchemy import UnicodeText
 
+from lobbyfacts.core import app
 from lobbyfacts.data import sl, etl_engine
+from lobbyfacts.data.lib.bulk import bulk_update, ensure_columns
+from lobbyfacts.data.lib.processing import threaded, RateLimiter
 
 log = logging.getLogger(__name__)
 
 URL = "http://nominatim.openstreetmap.org/search"
 URL = "http://open.mapquestapi.com/nominatim/v1/search.php"
 
-def transform(engine):
+FIELDS = ('street', 'post_code', 'town', 'country')
+
+
+def normalize(value):
+    if value is None:
+        return u''
+    if not isinstance(value, unicode):
+        value = value.decode('utf-8')
+    return u' '.join(value.lower().split())
+
+
+def address_key(row):
+    """ The normalised (street, post_code, town, country) tuple of a
+    contact or cache row. """
+    return tuple(normalize(row.get(f)) for f in FIELDS)
+
+
+def cache_id(key):
+    return sha1(u'\x1f'.join(key).encode('utf-8')).hexdigest()
+
+
+class NominatimGeocoder(object):
+    """ Structured address search against a Nominatim endpoint. """
+
+    def __init__(self, url=URL):
+        self.url = url
+
+    def geocode(self, street, post_code, town, country):
+        query = {
+            'format': 'json',
+            'limit': 1,
+            'city': town,
+            'street': street,
+            'country': country,
+            'postalcode': post_code
+            }
+        response = requests.get(self.url, params=query)
+        response.raise_for_status()
+        json = response.json()
+        if not json or not len(json):
+            return None
+        geo = json[0]
+        return {'geoname': geo.get('display_name'),
+                'lon': geo.get('lon'),
+                'lat': geo.get('lat')}
+
+
+class GazetteerGeocoder(object):
+    """ Offline lookups in a CSV file with street, post_code, town,
+    country, geoname, lon and lat columns. Addresses that do not match
+    a full row fall back to the row for their town. """
+
+    def __init__(self, file_name):
+        self.places = {}
+        with open(file_name, 'rb') as fh:
+            for row in csv.DictReader(fh):
+                row = dict((k, v.decode('utf-8')) for k, v in row.items())
+                self.places.setdefault(address_key(row), row)
+
+    def geocode(self, street, post_code, town, country):
+        key = address_key(dict(zip(FIELDS, (street, post_code, town, country))))
+        place = self.places.get(key) or \
+                self.places.get((u'', u'', key[2], key[3]))
+        if place is None:
+            return None
+        return {'geoname': place.get('geoname'),
+                'lon': place.get('lon'),
+                'lat': place.get('lat')}
+
+
+GEOCODERS = {
+    'nominatim': lambda: NominatimGeocoder(
+        app.config.get('ETL_GEOCODER_URL', URL)),
+    'gazetteer': lambda: GazetteerGeocoder(
+        app.config.get('ETL_GEOCODER_GAZETTEER', 'gazetteer.csv'))
+    }
+
+
+def get_geocoder():
+    return GEOCODERS[app.config.get('ETL_GEOCODER', 'nominatim')]()
+
+
+def load_cache(engine):
+    """ Cached results by address key, including addresses that were
+    not found. """
+    table = sl.get_table(engine, 'geocode_cache')
+    if 'key' not in table.c:
+        return {}
+    return dict((row['key'], row) for row in sl.all(engine, table))
+
+
+def transform(engine, geocoder=None):
+    """ Geo-code all contacts without coordinates. Each distinct address
+    is only looked up once, and results are kept in the geocode_cache
+    table so that re-runs only resolve new addresses. """
     log.info("Geo-coding representatives...")
+    geocoder = geocoder or get_geocoder()
     table = sl.get_table(engine, 'contact')
+    addresses = {}
     for row in sl.all(engine, table):
-        out = {'id': row['id']}
         if row.get('lon'):
             continue
-        query = {
-            'format': 'json',
-            'limit': 1,
-            'city': row.get('town'),
-            'street': row.get('street'),
-            'country': row.get('country'),
-            'postalcode': row.get('post_code')
-            }
-        response = requests.get(URL, params=query)
-        try:
-            json = response.json()
-        except: continue
-        if json and len(json):
-            geo = json[0]
-            log.info("%s @ %s", row.get('name'), geo.get('display_name'))
-            out['geoname'] = geo.get('display_name')
-            out['lon'] = geo.get('lon')
-            out['lat'] = geo.get('lat')
-            sl.upsert(engine, table, out, ['id'])
+        key = address_key(row)
+        addresses.setdefault(key, (row, []))[1].append(row['id'])
+
+    cache_table = sl.get_table(engine, 'geocode_cache')
+    cache = load_cache(engine)
+    todo = [k for k in addresses if cache_id(k) not in cache]
+    log.info("Addresses to geo-code: %s (%s cached)", len(todo),
+             len(addresses) - len(todo))
+    limiter = RateLimiter(app.config.get('ETL_GEOCODE_RATE', 1))
+    lock = Lock()
+
+    def process(key):
+        row = addresses[key][0]
+        limiter.wait()
+        geo = geocoder.geocode(*[row.get(f) for f in FIELDS])
+        entry = dict(zip(FIELDS, key))
+        entry.update(geo or {})
+        entry.update({'key': cache_id(key),
+                      'found': geo is not None,
+                      'geocoded_at': datetime.utcnow()})
+        with lock:
+            sl.upsert(engine, cache_table, entry, ['key'])
+            cache[entry['key']] = entry
+
+    threaded(todo, process,
+             num_threads=app.config.get('ETL_GEOCODE_THREADS', 4))
+
+    ensure_columns(engine, table, {'geoname': UnicodeText,
+                                   'lon': UnicodeText,
+                                   'lat': UnicodeText})
+    updates = []
+    for key, (row, ids) in addresses.items():
+        geo = cache.get(cache_id(key))
+        if geo is None or not geo.get('found'):
+            continue
+        log.debug("%s @ %s", row.get('name'), geo.get('geoname'))
+        for id in ids:
+            updates.append({'id': id,
+                            'geoname': geo.get('geoname'),
+                            'lon': geo.get('lon'),
+                            'lat': geo.get('lat')})
+    bulk_update(engine, 'contact', 'id', updates)
 
 if __name__ == '__main__':
     engine = etl_engine()
@@ -1,9 +1,12 @@
 from pprint import pprint
 import logging
 
+from sqlalchemy import UnicodeText, Boolean
+
 from lobbyfacts.data import sl, etl_engine
-from lobbyfacts.data.lib.reference import canonical
-from lobbyfacts.data.lib.countries import country_by_name
+from lobbyfacts.data.lib.bulk import bulk_update, ensure_columns
+from lobbyfacts.data.lib.reference import canonical, save_misses
+from lobbyfacts.data.lib.countries import lookup_country
 
 log = logging.getLogger(__name__)
 
@@ -11,29 +14,39 @@ DATASET = 'openinterests-entities'
 
 def map_names(map_func, engine, table_name, source_column='name',
               out_column='canonical_name', filt={}, **kw):
+    """ Resolve each distinct value of `source_column` once and write
+    the results back to all matching rows in one bulk update. """
     table = sl.get_table(engine, table_name)
-    seen_values = set([None])
     log.info("Normalising names on '%s', column '%s'...", table_name,
              source_column)
-    for row in sl.find(engine, table, **filt):
-        value = row.get(source_column)
-        if value in seen_values:
+    if source_column not in table.c:
+        return
+    ensure_columns(engine, table, {out_column: UnicodeText,
+                                   'etl_clean': Boolean})
+    values = [r[source_column] for r in
+              sl.distinct(engine, table, source_column, **filt)]
+    rows = []
+    for value in values:
+        if value is None:
             continue
-        seen_values.add(value)
         d = {source_column: value, 'etl_clean': True,
              out_column: None}
+        context = {'table': table_name, source_column: value}
         try:
-            out = map_func(value, row, **kw)
+            out = map_func(value, context, **kw)
             if out is None:
                 d['etl_clean'] = False
             else:
                 d[out_column] = out
         except ValueError, ve:
             d['etl_clean'] = False
-        sl.upsert(engine, table, d, [source_column])
+        rows.append(d)
+    bulk_update(engine, table_name, source_column, rows)
 
 def transform(engine):
-    countries_func = lambda v, c: country_by_name(v).get('iso2')
+    def countries_func(v, c):
+        country = lookup_country(v)
+        return country.get('iso2') if country else None
     map_names(countries_func, engine, 'contact',
             'country', 'country_code')
     map_names(countries_func, engine, 'country_of_member',
@@ -50,6 +63,7 @@ def transform(engine):
     map_names(names_func, engine, 'network_entity', readonly=True)
     map_names(names_func, engine, 'expertgroup_member', readonly=True)
     map_names(names_func, engine, 'meeting', 'representative', filt={'identification_code': 'unregistered'})
+    save_misses()
 
 if __name__ == '__main__':
     engine = etl_engine()
@@ -8,10 +8,49 @@ SQLALCHEMY_DATABASE_URI = 'postgresql://localhost/lobbyfacts'
 
 NOMENKLATURA_URL = 'http://nomenklatura.okfnlabs.org'
 NOMENKLATURA_APIKEY = None
+# local copy of the reference dataset, updated by refresh_reference
+NOMENKLATURA_SNAPSHOT = 'reference-snapshot'
 
 ETL_URL = 'sqlite:///etl.db'
 ETL_URL = 'postgresql://localhost/lobbyfacts_etl'
 
+# local cache of downloaded register files
+ETL_DOWNLOAD_CACHE = 'download-cache'
+
+# number of processes parsing the register dump
+ETL_EXTRACT_WORKERS = 1
+
+# meetings crawler: parallel host chains and requests per server
+ETL_CRAWL_THREADS = 8
+ETL_CRAWL_HOST_LIMIT = 4
+
+# on-disk cache of scraped pages: (url regex, seconds) freshness rules,
+# first match wins, other pages are always refetched. In offline mode
+# pages are only replayed from the cache.
+ETL_PAGE_CACHE = 'page-cache'
+ETL_PAGE_CACHE_TTL = [
+    (r'regexpert/.*detailMember', 7 * 86400),
+    (r'regexpert/.*groupDetail', 86400),
+    (r'transparencyinitiative/meetings/.*predecessor', 7 * 86400),
+    ]
+ETL_PAGE_CACHE_OFFLINE = False
+
+# expert group scraper: worker threads and requests per second overall
+ETL_REGEXPERT_THREADS = 8
+ETL_REGEXPERT_RATE = 4
+
+# geocoding backend ('nominatim' or an offline 'gazetteer' CSV file),
+# worker threads and requests per second
+ETL_GEOCODER = 'nominatim'
+ETL_GEOCODER_GAZETTEER = 'gazetteer.csv'
+ETL_GEOCODE_THREADS = 4
+ETL_GEOCODE_RATE = 1
+
+# representatives loaded into production per transaction
+ETL_LOAD_CHUNK = 200
+# processes loading representatives, partitioned by identification code
+ETL_LOAD_WORKERS = 1
+
 ETL_PYBOSSA_HOST = 'http://pybossa.com'
 ETL_PYBOSSA_KEY = None # fill in from http://pybossa.com/account/profile
 
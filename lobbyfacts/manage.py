@@ -12,22 +12,22 @@ def createdb():
     db.create_all()
 
 @manager.command
-def extract():
+def extract(full=False):
     """ Extract all data from the respective web sources. """
     from lobbyfacts.data import etl_engine
     engine = etl_engine()
     from lobbyfacts.data.extract.reginterests import extract
-    extract(engine)
+    registry_changed = extract(engine, full=full)
     from lobbyfacts.data.extract.regaccredit import extract
-    extract(engine)
-    #from lobbyfacts.data.extract.regexpert import extract
-    #extract(engine)
+    extract(engine, full=full, registry_changed=registry_changed)
+    from lobbyfacts.data.extract.regexpert import extract
+    extract(engine, full=full)
     from lobbyfacts.data.extract.unreginterest import extract
     extract(engine)
     from lobbyfacts.data.extract.tag import extract
-    extract(engine)
+    extract(engine, full=full, registry_changed=registry_changed)
     from lobbyfacts.data.extract.meetings import extract
-    extract(engine)
+    extract(engine, full=full)
 
 @manager.command
 def transform():
@@ -40,22 +40,34 @@ def transform():
     #transform(engine)
     from lobbyfacts.data.transform.names import transform
     transform(engine)
-    #from lobbyfacts.data.transform.dedup import transform
-    #transform(engine)
+    from lobbyfacts.data.transform.dedup import transform
+    transform(engine)
     from lobbyfacts.data.transform.geocode import transform
     transform(engine)
 
 @manager.command
-def load():
+def refresh_reference():
+    """ Submit queued name misses to nomenklatura and update the local
+    snapshot used to canonicalise names. """
+    from lobbyfacts.data.lib.reference import refresh
+    from lobbyfacts.data.transform.names import DATASET
+    refresh(DATASET)
+
+@manager.command
+def load(full=False, dry_run=False):
     """ Load the data from ETL into the production database. """
     from lobbyfacts.data import etl_engine
     engine = etl_engine()
+    if dry_run:
+        from lobbyfacts.data.load.reginterests import load
+        load(engine, full=full, dry_run=True)
+        return
     from lobbyfacts.data.load.common import load
     load(engine)
     from lobbyfacts.data.load.reginterests import load
-    load(engine)
+    load(engine, full=full)
     from lobbyfacts.model import update_index
-    update_index()
+    update_index(full=full)
     from lobbyfacts.data.load.meetings import load
     load(engine)
 
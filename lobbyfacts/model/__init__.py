@@ -1,4 +1,7 @@
 import logging
+from datetime import datetime
+
+from lobbyfacts.core import db
 
 from lobbyfacts.model.entity import Entity
 from lobbyfacts.model.representative import Representative, Tags, Contact
@@ -35,10 +38,46 @@ REPORTS = {
     'reps_by_eufunding': reps_by_eufunding,
     }
 
-def update_index():
-    from lobbyfacts.core import db
-    for entity in db.session.query(Entity).yield_per(1000):
-        log.info("Indexing %s...", entity.name)
-        entity.update_index()
-        #db.session.add(entity)
+def _source_text(model):
+    """ SQL aggregating the text columns of a model per entity, along
+    with the time any of its rows last changed. """
+    table = model.__table__
+    q = db.engine.dialect.identifier_preparer.quote
+    columns = [q(c.name) for c in table.c if isinstance(c.type, db.String)
+               and c.name != 'id' and not c.name.endswith('_id')]
+    return ("SELECT entity_id, string_agg(concat_ws(' ', %s), ' ') AS text, "
+            "max(updated_at) AS updated_at FROM %s GROUP BY entity_id") % (
+            ', '.join(columns), q(table.name))
+
+def update_index(full=False):
+    """ Rebuild the full-text index of entities. On PostgreSQL this is
+    one UPDATE over the entity, person, organisation and representative
+    text columns, touching only entities that changed since the last
+    build unless `full` is set; other databases index entity by
+    entity. """
+    if db.engine.dialect.name != 'postgresql':
+        for entity in db.session.query(Entity).yield_per(1000):
+            log.info("Indexing %s...", entity.name)
+            entity.update_index()
+            #db.session.add(entity)
+        db.session.commit()
+        return
     db.session.commit()
+    db.engine.execute('ALTER TABLE entity ADD COLUMN IF NOT EXISTS '
+                      'indexed_at TIMESTAMP WITHOUT TIME ZONE')
+    sources = [('p', Person), ('o', Organisation), ('r', Representative)]
+    changed = ['entity.indexed_at IS NULL',
+               'entity.updated_at > entity.indexed_at']
+    changed += ['%s.updated_at > entity.indexed_at' % a for a, m in sources]
+    stmt = """UPDATE entity SET indexed_at = %%(now)s,
+            full_text = to_tsvector(concat_ws(' ', entity.name,
+                entity.acronym, %s))
+        FROM entity AS e %s
+        WHERE entity.id = e.id""" % (
+        ', '.join('%s.text' % a for a, m in sources),
+        ' '.join('LEFT OUTER JOIN (%s) AS %s ON %s.entity_id = e.id' % (
+                 _source_text(m), a, a) for a, m in sources))
+    if not full:
+        stmt += ' AND (%s)' % ' OR '.join(changed)
+    res = db.engine.execute(stmt, now=datetime.utcnow())
+    log.info("Indexed %s entities", res.rowcount)
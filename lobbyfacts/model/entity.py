@@ -9,6 +9,9 @@ class Entity(db.Model, RevisionedMixIn, ApiEntityMixIn):
     name = db.Column(db.Unicode)
     acronym = db.Column(db.Unicode)
     full_text = db.Column(TSVector)
+    # when full_text was last built by update_index; deferred so that
+    # databases which predate it can still be queried.
+    indexed_at = db.deferred(db.Column(db.DateTime))
 
     def update_values(self, data):
         self.name = data.get('name')
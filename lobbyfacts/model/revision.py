@@ -56,6 +56,9 @@ class RevisionedMixIn(object):
     updated_at = db.Column(db.DateTime)
     deleted_at = db.Column(db.DateTime)
 
+    # bulk loaders set this and flush in chunks themselves.
+    defer_flush = False
+
     @classmethod
     def create(cls, data):
         """ Create a new, versioned object. """
@@ -72,9 +75,14 @@ class RevisionedMixIn(object):
             if [x for x in attr.history.added or [] if x] or [x for x in attr.history.deleted or [] if x]:
                 self.updated_at = datetime.utcnow()
                 action = AuditTrail.UPDATE if self.created_at else AuditTrail.CREATE
+                if self.created_at is None:
+                    # set here rather than on flush, so that further
+                    # updates before the next flush count as updates.
+                    self.created_at = self.updated_at
                 AuditTrail.create(self, action)
                 break
-        db.session.flush()
+        if not self.defer_flush:
+            db.session.flush()
         return self
 
     def update_values(self, data):